@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Graph families used by the benchmarks. Every generator is seeded, so that the benchmark cases are reproducible.
+"""
+
+import os
+import sys
+
+import numpy as np
+import scipy.sparse as sp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tutorials'))
+
+
+def maze(n, seed=0):
+    """ Adjacency of a perfect square maze with about n nodes, generated with tutorials/maze.py. """
+    from maze import Maze
+
+    side = max(2, int(round(np.sqrt(n))))
+    return Maze(maze_size=(side, side), rng=seed).adjacency
+
+
+def random_sparse(n, seed=0, degree=4):
+    """ Symmetric random graph with n nodes and mean degree about degree, as a sparse matrix. """
+    rng = np.random.default_rng(seed)
+    edges = degree * n // 2
+    rows, cols = rng.integers(0, n, edges), rng.integers(0, n, edges)
+    adjacency = sp.csr_matrix((np.ones(edges), (rows, cols)), shape=(n, n))
+    adjacency = adjacency + adjacency.T
+    adjacency.setdiag(0)
+    adjacency.eliminate_zeros()
+    adjacency.data[:] = 1.
+    return adjacency
+
+
+def complete(n, seed=0):
+    """ Adjacency of the complete graph with n nodes. """
+    return np.ones((n, n)) - np.eye(n)
+
+
+FAMILIES = {'maze': maze, 'random': random_sparse, 'complete': complete}
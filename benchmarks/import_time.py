@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Import time budget of the package: `from sqwalk import SQWalker` is timed in fresh interpreters, as in the spawned
+worker processes, and must neither exceed the budget nor load the heavy optional dependencies.
+
+Usage:
+    python benchmarks/import_time.py --budget 1.0
+
+The exit code is 1 if the best import time is over the budget or if any of the forbidden modules is loaded.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+STATEMENT = 'from sqwalk import SQWalker'
+FORBIDDEN = ('qiskit', 'qutip', 'matplotlib', 'h5py')
+
+# run in a fresh interpreter, prints the import time and the forbidden modules that were loaded
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'time': elapsed, 'loaded': [m for m in {forbidden!r} if m in sys.modules]}}))
+"""
+
+
+def import_time(statement=STATEMENT, repeat=5):
+    """ Best import time of statement over repeat fresh interpreters and the forbidden modules it loads. """
+    probe = _PROBE.format(statement=statement, forbidden=FORBIDDEN)
+    times, loaded = [], set()
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', probe], cwd=ROOT, check=True, stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        times.append(result['time'])
+        loaded.update(result['loaded'])
+    return min(times), sorted(loaded)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget', type=float, default=1.0, help='largest import time in seconds')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters, the best time is kept')
+    parser.add_argument('--statement', default=STATEMENT, help='import statement to time')
+    args = parser.parse_args(argv)
+
+    elapsed, loaded = import_time(args.statement, args.repeat)
+    print('{}: {:.3f} s (budget {:.3f} s)'.format(args.statement, elapsed, args.budget))
+    failed = False
+    if elapsed > args.budget:
+        print('Import time over budget')
+        failed = True
+    if loaded:
+        print('Heavy modules loaded on import: {}'.format(', '.join(loaded)))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of the walker: construction time, solve time and peak memory over graph families, sizes, noise
+levels and with or without a sink. Results are written as JSON and can be compared against a stored baseline.
+
+Usage:
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --baseline baseline.json --threshold 1.3
+
+The exit code is 1 if any timing or memory of a case present in the baseline grew more than the threshold.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from graphs import FAMILIES  # noqa: E402
+from sqwalk import SQWalker  # noqa: E402
+from sqwalk.objects import _select_method  # noqa: E402
+
+SIZES = {'quick': {'maze': [16, 64], 'random': [16, 64], 'complete': [16]},
+         'full': {'maze': [16, 64, 256, 1024], 'random': [16, 64, 256, 1024, 4096], 'complete': [16, 64]}}
+NOISE = [0., 0.1, 0.5, 1.]
+METRICS = ('construction_time', 'solve_time', 'peak_memory')
+
+
+def measure(function, repeat):
+    """ Best wall time over repeat runs and peak traced memory of the first run of function. """
+    tracemalloc.start()
+    start = time.perf_counter()
+    value = function()
+    best = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return value, best, peak
+
+
+def run_case(family, n, noise_param, sink, method, time_samples, dt, repeat):
+    adjacency = FAMILIES[family](n)
+    sink_node = adjacency.shape[0] - 1 if sink else None
+
+    def construct():
+        walker = SQWalker(adjacency, noise_param=noise_param, sink_node=sink_node)
+        # the Liouvillian is only built for the engines that use it, the runs start from a node (a pure state)
+        if _select_method(method, noise_param, walker.hermitian and not walker.sink_nodes, True) not in (
+                'classical', 'unitary', 'trajectories'):
+            walker.liouvillian()
+        return walker
+
+    walker, construction_time, construction_memory = measure(construct, repeat)
+    _, solve_time, solve_memory = measure(
+        lambda: walker.run_walker(0, time_samples, dt=dt, method=method), repeat)
+    return {'family': family, 'nodes': adjacency.shape[0], 'noise_param': noise_param, 'sink': sink,
+            'method': method, 'time_samples': time_samples, 'construction_time': construction_time,
+            'solve_time': solve_time, 'peak_memory': max(construction_memory, solve_memory)}
+
+
+def applies(method, noise_param, sink):
+    """ False for the reduced engines outside of their limits, which run_walker rejects (the graphs of the families
+    are undirected and the runs start from a node). """
+    return not ((method == 'classical' and noise_param != 1) or (method == 'unitary' and (noise_param != 0 or sink)))
+
+
+def warm_up(noise, methods):
+    """ Runs throwaway cases on a tiny graph, so that the lazy imports (QuTip and matplotlib) and the first call
+    overheads of every engine are not charged to the first measured case. """
+    import qutip  # noqa: F401
+
+    for noise_param, sink, method in itertools.product(noise, (False, True), methods):
+        if applies(method, noise_param, sink):
+            run_case('complete', 4, noise_param, sink, method, 2, 1e-2, 1)
+
+
+def case_key(case):
+    return '%(family)s/n=%(nodes)d/p=%(noise_param)g/sink=%(sink)s/%(method)s' % case
+
+
+def compare(results, baseline, threshold):
+    """ Cases of results slower or heavier than the baseline by more than the threshold ratio. """
+    reference = {case_key(case): case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        if case_key(case) not in reference:
+            continue
+        for metric in METRICS:
+            old, new = reference[case_key(case)][metric], case[metric]
+            if old > 0 and new / old > threshold:
+                regressions.append({'case': case_key(case), 'metric': metric, 'baseline': old, 'current': new,
+                                    'ratio': new / old})
+    return regressions
+
+
+def environment():
+    versions = {'python': platform.python_version(), 'platform': platform.platform()}
+    for module in ('numpy', 'scipy', 'qutip'):
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            versions[module] = None
+    return versions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='benchmark_results.json', help='path of the JSON results')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='ratio to the baseline flagged as regression')
+    parser.add_argument('--suite', choices=sorted(SIZES), default='quick', help='set of graph sizes')
+    parser.add_argument('--families', nargs='+', choices=sorted(FAMILIES), default=sorted(FAMILIES))
+    parser.add_argument('--noise', nargs='+', type=float, default=NOISE)
+    parser.add_argument('--methods', nargs='+', default=[None], help="engines of run_walker, default automatic")
+    parser.add_argument('--time-samples', type=int, default=100)
+    parser.add_argument('--dt', type=float, default=1e-2)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    methods = [None if method in (None, 'None', 'auto') else method for method in args.methods]
+    warm_up(args.noise, methods)
+    cases = []
+    for family in args.families:
+        for n, noise_param, sink, method in itertools.product(SIZES[args.suite][family], args.noise, (False, True),
+                                                              methods):
+            if not applies(method, noise_param, sink):
+                continue
+            case = run_case(family, n, noise_param, sink, method, args.time_samples, args.dt, args.repeat)
+            cases.append(case)
+            print('%-45s construction %.4fs  solve %.4fs  peak %.1f MB' % (
+                case_key(case), case['construction_time'], case['solve_time'], case['peak_memory'] / 2 ** 20))
+
+    results = {'environment': environment(), 'suite': args.suite, 'cases': cases}
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as file:
+            results['regressions'] = compare(results, json.load(file), args.threshold)
+        for regression in results['regressions']:
+            print('REGRESSION %(case)s %(metric)s: %(baseline).4g -> %(current).4g (x%(ratio).2f)' % regression)
+        status = 1 if results['regressions'] else 0
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
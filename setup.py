@@ -16,8 +16,12 @@ setup(name='sqwalk',
       install_requires=[
           'qutip',
           'numpy',
+          'scipy',
           'matplotlib',
           'qiskit'
       ],
+      extras_require={
+          'hdf5': ['h5py']
+      },
       include_package_data=True,
       zip_safe=False)
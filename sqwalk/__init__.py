@@ -1,2 +1,25 @@
-from .utils import gate_decomposition
-from .objects import SQWalker
\ No newline at end of file
+import importlib
+
+# public names and the submodules defining them, imported on first access so that e.g. `from sqwalk import SQWalker`
+# does not load qiskit
+_exports = {
+    'gate_decomposition': 'utils',
+    'gate_decomposition_batch': 'utils',
+    'SQWalker': 'objects',
+    'WalkerStats': 'profiling',
+    'run_ensemble': 'ensemble',
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module('.' + _exports[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def graph_hash(adjacency, *parameters):
+    """ Content hash of an adjacency matrix and of any other parameter (sinks, rates, precision...).
+
+    Parameters
+    ----------
+    adjacency : np.array or scipy.sparse matrix
+        adjacency matrix of the graph
+    parameters : objects with a stable repr
+        other parameters the cached data depends on
+
+    Returns
+    -------
+    str
+        hexadecimal sha256 digest
+    """
+    # a canonical copy, without the explicit zeros kept by SQWalker.update_edges
+    adjacency = sp.csr_matrix(adjacency, dtype=float, copy=True)
+    adjacency.sum_duplicates()
+    adjacency.eliminate_zeros()
+    adjacency.sort_indices()
+    digest = hashlib.sha256()
+    digest.update(repr(adjacency.shape).encode())
+    digest.update(adjacency.data.tobytes())
+    digest.update(adjacency.indices.astype(np.int64).tobytes())
+    digest.update(adjacency.indptr.astype(np.int64).tobytes())
+    digest.update(repr(parameters).encode())
+    return digest.hexdigest()
+
+
+def _file_size(path):
+    """ Size of a file, 0 if it was removed. """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class OperatorCache(object):
+    """
+    Persistent on-disk cache of the operators built by the walkers, shared by processes and jobs.
+
+    Every entry is a directory named by a content hash (see graph_hash) containing one .npy file per array,
+    which is loaded memory-mapped so that walkers use the stored operators without copying them in memory.
+    When the total size exceeds max_bytes the least recently used entries are evicted.
+
+    Parameters
+    ----------
+    directory : str
+        directory of the cache, created if missing
+    max_bytes : int (default 2**32)
+        maximum total size of the cache on disk
+    """
+    def __init__(self, directory, max_bytes=2 ** 32):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, name):
+        return os.path.join(self.directory, key, name)
+
+    def load_arrays(self, key, name):
+        """ Memory-mapped arrays stored under key/name, or None if missing. """
+        path = self._path(key, name)
+        if not os.path.isdir(path):
+            return None
+        try:
+            arrays = {file[:-4]: np.load(os.path.join(path, file), mmap_mode='r')
+                      for file in os.listdir(path) if file.endswith('.npy')}
+        except (OSError, ValueError):  # entry evicted or being written by another process
+            return None
+        try:
+            os.utime(os.path.join(self.directory, key))  # last access for the LRU eviction
+        except OSError:  # evicted after loading, the memory-mapped files stay readable
+            pass
+        return arrays
+
+    def store_arrays(self, key, name, arrays):
+        """ Stores a dict of arrays under key/name, atomically with respect to other processes. """
+        staging = None
+        try:
+            os.makedirs(os.path.join(self.directory, key), exist_ok=True)
+            staging = tempfile.mkdtemp(dir=os.path.join(self.directory, key))
+            for field, array in arrays.items():
+                np.save(os.path.join(staging, field + '.npy'), np.asarray(array))
+            os.rename(staging, self._path(key, name))
+        except OSError:  # already stored, or the entry was evicted meanwhile by another process
+            if staging is not None:
+                shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def load_sparse(self, key, name):
+        """ Sparse CSR matrix stored under key/name sharing the memory-mapped arrays, or None if missing. """
+        arrays = self.load_arrays(key, name)
+        if arrays is None:
+            return None
+        return sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(arrays['shape']),
+                             copy=False)
+
+    def store_sparse(self, key, name, matrix):
+        matrix = sp.csr_matrix(matrix)
+        self.store_arrays(key, name, {'data': matrix.data, 'indices': matrix.indices, 'indptr': matrix.indptr,
+                                      'shape': np.array(matrix.shape)})
+
+    def size(self):
+        """ Total size in bytes of the cache and size of each entry. Files removed meanwhile by other processes
+        are not counted. """
+        sizes = {}
+        for key in os.listdir(self.directory):
+            sizes[key] = sum(_file_size(os.path.join(root, file))
+                             for root, _, files in os.walk(os.path.join(self.directory, key)) for file in files)
+        return sum(sizes.values()), sizes
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits in max_bytes. """
+        total, sizes = self.size()
+        access = {}
+        for key in sizes:
+            try:
+                access[key] = os.path.getmtime(os.path.join(self.directory, key))
+            except OSError:  # already evicted by another process
+                total -= sizes[key]
+        for key in sorted(access, key=access.get):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            total -= sizes[key]
+
+    def clear(self):
+        for key in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
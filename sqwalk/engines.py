@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Propagation engines for the master equation of the walker.
+
+The generic engines act on a batch of vectorized (column-stacked) density matrices stored as the columns of a
+(dim**2, batch) array, while the engines of the fully classical and fully quantum limits keep an N-dimensional
+representation of the state. Every engine prepares the batch from a list of density matrices, yields it at each
+of the requested times (the prepared states being taken at times[0] as in QuTip's mesolve), evaluates
+expectation values on it and converts it back to density matrices. The batch is also saved as a dict of arrays and
+loaded back (save_state and load_state), so that checkpoints keep the compact representation of each engine.
+
+The vectorized engines run in the precision of their generator (e.g. complex64 for a single precision walker),
+except for the ODE engine which is double precision only. Hermitian density matrices can also be packed into n**2
+real numbers (see PackedEngine), which halves the memory of the states and of the generator.
+"""
+
+import numpy as np
+import scipy.integrate
+import scipy.linalg
+import scipy.sparse as sp
+from scipy.sparse.linalg import expm_multiply
+
+
+def _nbytes(matrix):
+    """ Memory of the arrays of a dense or sparse matrix. """
+    if sp.issparse(matrix):
+        matrix = matrix.tocsr()
+        return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+    return matrix.nbytes
+
+
+class VectorizedEngine(object):
+    """ Base class of the engines acting on vectorized density matrices, stored with the complex type self.dtype.
+    """
+    dtype = np.complex128
+
+    def prepare(self, density_matrices):
+        return np.array([rho.toarray().ravel(order='F') for rho in density_matrices], dtype=self.dtype).T
+
+    def observables(self, operators):
+        if len(operators) == 0:
+            return np.zeros((0, 0))
+        return np.array([op.toarray().ravel() for op in operators])
+
+    def expect(self, observables, batch):
+        """ Expectation values (observable, batch) of the prepared observables, Tr(O rho) = vec(O^T) . vec(rho). """
+        if len(observables) == 0:
+            return np.zeros((0, batch.shape[1]))
+        return observables @ batch
+
+    def density(self, batch, b):
+        n = int(round(np.sqrt(batch.shape[0])))
+        return batch[:, b].reshape((n, n), order='F')
+
+    def populations(self, batch):
+        n = int(round(np.sqrt(batch.shape[0])))
+        return np.real(batch[::n + 1])
+
+    def save_state(self, batch):
+        return {'states': batch}
+
+    def load_state(self, arrays):
+        return np.asarray(arrays['states'], dtype=self.dtype)
+
+
+class ODEEngine(VectorizedEngine):
+    """ Adaptive integration of the master equation with the zvode solver used by QuTip's mesolve, or with its real
+    counterpart vode for real generators and states (e.g. packed states). The integration is in double precision.
+    """
+    def __init__(self, liouvillian, opts):
+        self.liouvillian = liouvillian
+        self.opts = opts
+        self.statistics = {}
+
+    def propagate(self, states, times):
+        shape = states.shape
+        real = not (np.iscomplexobj(self.liouvillian) or np.iscomplexobj(states))
+
+        def rhs(t, y):
+            return (self.liouvillian @ y.reshape(shape, order='F')).ravel(order='F')
+
+        opts = self.opts
+        r = scipy.integrate.ode(rhs)
+        r.set_integrator('vode' if real else 'zvode', method=opts.method, order=opts.order, atol=opts.atol,
+                         rtol=opts.rtol, nsteps=opts.nsteps, first_step=opts.first_step, min_step=opts.min_step,
+                         max_step=opts.max_step)
+        r.set_initial_value(np.asarray(states, dtype=float if real else complex).ravel(order='F'), times[0])
+        yield states
+        for t in times[1:]:
+            r.integrate(t)
+            if not r.successful():
+                raise Exception("ODE integration error: Try to increase the allowed number of substeps by "
+                                "increasing the nsteps parameter in the Options class.")
+            # cumulative counters of (z)vode: steps, right hand side evaluations, error and convergence failures
+            iwork = r._integrator.iwork
+            self.statistics.update(steps=int(iwork[10]), rhs_evaluations=int(iwork[11]),
+                                   rejected_steps=int(iwork[20] + iwork[21]))
+            yield r.y.reshape(shape, order='F')
+
+
+class KrylovEngine(VectorizedEngine):
+    """ Krylov propagation with scipy's expm_multiply, evaluated on blocks of a uniform time grid.
+
+    expm_multiply returns all the states of a block at once and holds a few more copies of them while computing, so
+    the number of time samples of a block is also limited by max_bytes, down to a single step for large graphs. Every
+    call estimates the norms of the generator, which costs as much as propagating several samples, so large blocks
+    are much faster. The time grid mode computes in double precision, so single precision states are always
+    propagated one step at a time, which keeps the whole propagation in single precision.
+
+    The cost of a block also grows with its number of samples, so the ODE engine, whose adaptive steps are not tied
+    to the samples, is faster for finely sampled runs, e.g. on the default grid of run_walker (dt = 0.01). Krylov
+    only pays off on coarse grids and for long single jumps, with time steps of several times the inverse 1-norm
+    of the generator: on a 144 node maze with p = 0.5 (norm 6.8), 1000 samples with dt = 0.01 take 4.7s with Krylov
+    and 2.5s with ODE, the two engines are even at dt = 0.5 to 1, and 50 samples with dt = 2 take 0.9s and 1.8s.
+    On a 400 node maze (norm 5.5) 25 samples with dt = 4 take 8.9s and 16.8s.
+
+    Parameters
+    ----------
+    liouvillian : scipy.sparse matrix
+        generator of the dynamics
+    block : integer (default 256)
+        maximum number of time samples computed by a single call of expm_multiply
+    max_bytes : integer (default None)
+        maximum size of the states of a block, by default 16 times the size of the generator and at least 64 MB,
+        i.e. about a hundred samples for a maze of any size
+    """
+    def __init__(self, liouvillian, block=256, max_bytes=None):
+        self.liouvillian = liouvillian
+        self.block = block
+        self.max_bytes = max(2 ** 26, 16 * _nbytes(liouvillian)) if max_bytes is None else max_bytes
+        self.dtype = np.result_type(liouvillian.dtype, np.complex64)
+        self.statistics = {'krylov_calls': 0}
+
+    def propagate(self, states, times):
+        yield states
+        dtype = states.dtype
+        times = np.asarray(times)
+        steps = np.diff(times)
+        if len(steps) == 0:
+            return
+        if not np.allclose(steps, steps[0]):
+            # non uniform grid, one Krylov propagation per interval
+            for step in steps:
+                states = expm_multiply(float(step) * self.liouvillian, states)
+                self.statistics['krylov_calls'] += 1
+                yield states
+            return
+        # the time grid mode of expm_multiply always computes in double precision, so single precision states are
+        # propagated one step at a time
+        block = min(self.block, self.max_bytes // (states.size * np.dtype(np.complex128).itemsize))
+        if block <= 1 or np.finfo(dtype).dtype == np.float32:
+            step = float(steps[0]) * self.liouvillian
+            for _ in steps:
+                states = expm_multiply(step, states)
+                self.statistics['krylov_calls'] += 1
+                yield states
+            return
+        start = 0
+        while start < len(steps):
+            num = min(block, len(steps) - start)
+            states_block = expm_multiply(self.liouvillian, states, start=0., stop=num * steps[0], num=num + 1,
+                                         endpoint=True)
+            self.statistics['krylov_calls'] += 1
+            for states in states_block[1:]:
+                states = states.astype(dtype, copy=False)
+                yield states
+            start += num
+
+
+class PropagatorEngine(VectorizedEngine):
+    """ Repeated application of a dense one-step propagator exp(L dt), only viable for small graphs.
+
+    Parameters
+    ----------
+    propagator : np.array
+        (dim**2, dim**2) propagator over a single time step
+    dt : float
+        time step of the propagator, the time grid must be uniform with this step
+    """
+    def __init__(self, propagator, dt):
+        self.propagator = propagator
+        self.dt = dt
+        self.dtype = np.result_type(propagator.dtype, np.complex64)
+
+    def propagate(self, states, times):
+        steps = np.diff(times)
+        if not np.allclose(steps, self.dt):
+            raise ValueError('The propagator engine requires a uniform time grid with step dt')
+        yield states
+        for _ in steps:
+            states = self.propagator @ states
+            yield states
+
+
+def packing(n):
+    """ Sparse maps between the vectorized (column-stacked) n x n hermitian matrices and their packed form of n**2
+    real numbers: the n diagonal entries, followed by the real and the imaginary parts of the entries below the
+    diagonal (column by column).
+
+    Returns
+    -------
+    (scipy.sparse.csr_matrix, scipy.sparse.csr_matrix)
+        (n**2, n**2) matrices P and U such that P vec(rho) is the packed rho and U P vec(rho) = vec(rho)
+    """
+    m = n * (n - 1) // 2
+    diagonal = np.arange(n)
+    rows, cols = np.tril_indices(n, -1)
+    order = np.lexsort((rows, cols))
+    rows, cols = rows[order], cols[order]
+    lower, upper = rows + n * cols, cols + n * rows
+    real, imag = n + np.arange(m), n + m + np.arange(m)
+    pack = sp.csr_matrix((np.concatenate([np.ones(n), np.full(2 * m, 0.5), np.full(m, -0.5j), np.full(m, 0.5j)]),
+                          (np.concatenate([diagonal, real, real, imag, imag]),
+                           np.concatenate([diagonal * (n + 1), lower, upper, lower, upper]))), shape=(n * n, n * n))
+    unpack = sp.csr_matrix((np.concatenate([np.ones(n), np.ones(2 * m), np.full(m, 1j), np.full(m, -1j)]),
+                            (np.concatenate([diagonal * (n + 1), lower, upper, lower, upper]),
+                             np.concatenate([diagonal, real, real, imag, imag]))), shape=(n * n, n * n))
+    return pack, unpack
+
+
+def packed_positions(rows, cols, n, part='real'):
+    """ Positions in the packed vector (see packing) of the real or of the imaginary parts of the entries
+    rho[rows, cols] of n x n hermitian matrices.
+
+    Returns
+    -------
+    (np.array, np.array)
+        positions and signs relating the parts to the packed ones: 1 for the real parts, while the imaginary parts
+        have sign +1 below the diagonal, -1 above it and 0 on the diagonal, where they vanish
+    """
+    lower, upper = np.maximum(rows, cols), np.minimum(rows, cols)
+    positions = n + upper * (2 * n - upper - 1) // 2 + lower - upper - 1
+    if part == 'real':
+        diagonal = rows == cols
+        positions[diagonal] = rows[diagonal]
+        return positions, np.ones(len(positions))
+    positions += n * (n - 1) // 2
+    signs = np.sign(rows - cols)
+    positions[signs == 0] = 0
+    return positions, signs
+
+
+def _ranges(starts, stops, dtype=np.int64):
+    """ Concatenation of the ranges [starts[e], stops[e]), with the index e of the range of each value. """
+    lengths = stops - starts
+    entry = np.repeat(np.arange(len(starts), dtype=dtype), lengths)
+    values = np.arange(lengths.sum(), dtype=dtype)
+    values += np.repeat((starts - np.cumsum(lengths) + lengths).astype(dtype), lengths)
+    return entry, values
+
+
+def packed_coherent(hamiltonian, dtype=np.float64):
+    """ Real generator of the packed density matrices (see packing) of the coherent part -i[H, rho] of the master
+    equation, for a real symmetric Hamiltonian H, built from the entries of H without the complex superoperator.
+
+    Writing rho = X + iY with X symmetric and Y antisymmetric, dX/dt = [H, Y] and dY/dt = [X, H], whose entries below
+    (and on) the diagonal are sums of the products H[a, k] M[k, b] and M[a, k] H[k, b] of an entry of H with an
+    entry of X or Y.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        (n**2, n**2) real generator with the given dtype
+    """
+    hamiltonian = sp.coo_matrix(hamiltonian)
+    n = hamiltonian.shape[0]
+    # 32 bit positions whenever they fit, the temporaries have one entry per nonzero of the generator
+    index = np.int32 if 2 * n * n < 2 ** 31 else np.int64
+    h_rows, h_cols = hamiltonian.row.astype(index), hamiltonian.col.astype(index)
+    h = np.real(hamiltonian.data).astype(dtype)
+    # (state part, target part, H on the left, sign, first free index, last free index + 1) of each of the products
+    # +H[a, k] Y[k, b] and -Y[a, k] H[k, b] of dX[a, b] (a >= b), +X[a, k] H[k, b] and -H[a, k] X[k, b] of dY[a, b]
+    # (a > b), where the free index is b for H on the left and a otherwise
+    terms = [('imag', 'real', True, 1., 0, h_rows + 1), ('imag', 'real', False, -1., h_cols, n),
+             ('real', 'imag', False, 1., h_cols + 1, n), ('real', 'imag', True, -1., 0, h_rows)]
+    generator = sp.csr_matrix((n * n, n * n), dtype=dtype)
+    for source_part, target_part, left, sign, starts, stops in terms:
+        entry, free = _ranges(np.broadcast_to(starts, h.shape), np.broadcast_to(stops, h.shape), index)
+        if left:
+            a, b = h_rows[entry], free
+            sources, signs = packed_positions(h_cols[entry], b, n, source_part)
+        else:
+            a, b = free, h_cols[entry]
+            sources, signs = packed_positions(a, h_rows[entry], n, source_part)
+        targets, _ = packed_positions(a, b, n, target_part)
+        del a, b
+        values = (sign * signs).astype(dtype) * h[entry]
+        del entry, free, signs
+        generator = generator + sp.csr_matrix((values, (targets, sources)), shape=(n * n, n * n))
+    generator.eliminate_zeros()
+    return generator
+
+
+def packed_dissipator(rows, cols, rates, n, dtype=np.float64):
+    """ Real generator of the packed density matrices (see packing) of the Lindblad dissipator of the single-entry
+    jumps sqrt(rate) |row><col|: the populations follow the classical rate equation, while the real and the
+    imaginary part of every coherence rho[a, b] decay with rate (escape[a] + escape[b]) / 2.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        (n**2, n**2) real generator with the given dtype
+    """
+    escape = np.bincount(cols, weights=rates, minlength=n)
+    m = n * (n - 1) // 2
+    # the entries below the diagonal, column by column as in the packed vector
+    upper, lower = _ranges(np.arange(n) + 1, np.full(n, n))
+    decay = -0.5 * (escape[lower] + escape[upper])
+    data = np.concatenate([rates, -escape, decay, decay])
+    positions = np.concatenate([np.arange(n), n + np.arange(2 * m)])
+    row_index = np.concatenate([rows, positions])
+    col_index = np.concatenate([cols, positions])
+    nonzero = data != 0
+    return sp.csr_matrix((data[nonzero].astype(dtype), (row_index[nonzero], col_index[nonzero])),
+                         shape=(n * n, n * n))
+
+
+class PackedEngine(object):
+    """ Engine on hermitian density matrices packed as n**2 real numbers (see packing), which halves the memory of
+    the states. The propagation is delegated to a vectorized engine of the packed generator (see packed_coherent
+    and packed_dissipator), e.g. ODEEngine(walker.packed_liouvillian(), opts).
+
+    Parameters
+    ----------
+    engine : VectorizedEngine
+        engine of the packed generator
+    n : integer
+        dimension of the density matrices
+    """
+    def __init__(self, engine, n):
+        self.engine = engine
+        self.n = n
+        self.pack, self.unpack = packing(n)
+        self.dtype = np.real(np.zeros(0, dtype=engine.dtype)).dtype
+        self.statistics = getattr(engine, 'statistics', {})
+
+    def prepare(self, density_matrices):
+        states = []
+        for rho in density_matrices:
+            rho = sp.coo_matrix(rho)
+            vector = sp.csr_matrix((rho.data, (rho.row + self.n * rho.col, np.zeros(rho.nnz, dtype=int))),
+                                   shape=(self.n ** 2, 1))
+            packed = (self.pack @ vector).toarray().ravel()
+            if np.abs(np.imag(packed)).max(initial=0.) > 1e-10:
+                raise ValueError('Packed states require hermitian density matrices')
+            states.append(np.real(packed))
+        return np.array(states, dtype=self.dtype).T
+
+    def propagate(self, states, times):
+        return self.engine.propagate(states, times)
+
+    def observables(self, operators):
+        """ Rows of Tr(O rho) = vec(O^T) . U packed(rho). """
+        if len(operators) == 0:
+            return np.zeros((0, 0))
+        return np.array([self.unpack.T @ op.toarray().ravel() for op in operators])
+
+    def expect(self, observables, batch):
+        if len(observables) == 0:
+            return np.zeros((0, batch.shape[1]))
+        return observables @ batch
+
+    def density(self, batch, b):
+        return (self.unpack @ batch[:, b]).reshape((self.n, self.n), order='F')
+
+    def populations(self, batch):
+        return batch[:self.n]
+
+    def save_state(self, batch):
+        return {'states': batch}
+
+    def load_state(self, arrays):
+        return np.asarray(arrays['states'], dtype=self.dtype)
+
+
+def step_propagator(liouvillian, dt):
+    """ Dense propagator exp(L dt) of a sparse Liouvillian. """
+    return scipy.linalg.expm(dt * liouvillian.toarray())
+
+
+class ClassicalEngine(object):
+    """ Fully classical walker (p = 1). The populations follow the rate equation dP/dt = W P, propagated with
+    Krylov on N-dimensional vectors, while every coherence rho[a, b] of the initial states decays independently
+    with rate (escape[a] + escape[b]) / 2.
+
+    Parameters
+    ----------
+    rate_matrix : scipy.sparse matrix
+        (dim, dim) generator of the classical random walk
+    escape : np.array
+        total rate of the jumps leaving each node
+    """
+    def __init__(self, rate_matrix, escape):
+        self.krylov = KrylovEngine(rate_matrix)
+        self.escape = escape
+        self.n = len(escape)
+        self.statistics = self.krylov.statistics
+
+    def prepare(self, density_matrices):
+        dtype = self.krylov.liouvillian.dtype
+        populations = np.array([np.real(rho.diagonal()) for rho in density_matrices], dtype=dtype).T
+        # union of the off diagonal entries of the initial states, as flat column-major positions
+        coherences = [sp.coo_matrix(rho) for rho in density_matrices]
+        positions = np.unique(np.concatenate([(rho.row + self.n * rho.col)[rho.row != rho.col]
+                                              for rho in coherences]))
+        values = np.zeros((len(positions), len(coherences)), dtype=np.result_type(dtype, np.complex64))
+        for b, rho in enumerate(coherences):
+            off_diagonal = rho.row != rho.col
+            index = np.searchsorted(positions, (rho.row + self.n * rho.col)[off_diagonal])
+            np.add.at(values[:, b], index, rho.data[off_diagonal])
+        self.rows, self.cols = positions % self.n, positions // self.n
+        self.decay = 0.5 * (self.escape[self.rows] + self.escape[self.cols])
+        return populations, values
+
+    def propagate(self, states, times):
+        populations, coherences = states
+        for t, populations in zip(times, self.krylov.propagate(populations, times)):
+            yield populations, coherences * np.exp(-self.decay * (t - times[0]))[:, None]
+
+    def observables(self, operators):
+        operators = [sp.csr_matrix(op) for op in operators]
+        diagonal = np.array([op.diagonal() for op in operators]).reshape(len(operators), self.n)
+        # Tr(O rho) picks O[b, a] for the coherence rho[a, b]
+        off_diagonal = np.zeros((len(operators), len(self.rows)), dtype=complex)
+        if len(self.rows):
+            for m, op in enumerate(operators):
+                off_diagonal[m] = np.asarray(op[self.cols, self.rows]).ravel()
+        return diagonal, off_diagonal
+
+    def expect(self, observables, batch):
+        diagonal, off_diagonal = observables
+        populations, coherences = batch
+        return diagonal @ populations + off_diagonal @ coherences
+
+    def density(self, batch, b):
+        # sparse, with the populations and only the coherences of the initial states
+        populations, coherences = batch
+        diagonal = np.arange(self.n)
+        return sp.csr_matrix((np.concatenate([populations[:, b], coherences[:, b]]),
+                              (np.concatenate([diagonal, self.rows]), np.concatenate([diagonal, self.cols]))),
+                             shape=(self.n, self.n), dtype=coherences.dtype)
+
+    def populations(self, batch):
+        return batch[0]
+
+    def save_state(self, batch):
+        populations, coherences = batch
+        return {'populations': populations, 'coherences': coherences, 'rows': self.rows, 'cols': self.cols}
+
+    def load_state(self, arrays):
+        self.rows, self.cols = arrays['rows'], arrays['cols']
+        self.decay = 0.5 * (self.escape[self.rows] + self.escape[self.cols])
+        return arrays['populations'], arrays['coherences']
+
+
+class UnitaryEngine(object):
+    """ Closed continuous-time quantum walk (p = 0) on pure states, propagated in the eigenbasis of the
+    Hamiltonian with N-dimensional state vectors.
+
+    Parameters
+    ----------
+    eigenvalues : np.array
+        eigenvalues of the Hamiltonian
+    eigenvectors : np.array
+        unitary matrix of the eigenvectors of the Hamiltonian (as columns)
+    """
+    def __init__(self, eigenvalues, eigenvectors):
+        self.eigenvalues = eigenvalues
+        self.eigenvectors = eigenvectors
+
+    def prepare(self, density_matrices):
+        """ State vectors of pure density matrices, taken from the column of their largest population. """
+        kets = []
+        for rho in density_matrices:
+            rho = sp.csc_matrix(rho)
+            k = np.argmax(np.real(rho.diagonal()))
+            kets.append(rho[:, k].toarray().ravel() / np.sqrt(np.real(rho[k, k])))
+        dtype = np.result_type(self.eigenvectors.dtype, np.complex64)
+        return self.eigenvectors.conj().T @ np.array(kets, dtype=dtype).T
+
+    def propagate(self, states, times):
+        for t in times:
+            phases = np.exp(-1j * self.eigenvalues * (t - times[0])).astype(states.dtype)
+            yield self.eigenvectors @ (phases[:, None] * states)
+
+    def observables(self, operators):
+        return [sp.csr_matrix(op) for op in operators]
+
+    def expect(self, observables, batch):
+        return np.array([np.sum(batch.conj() * (op @ batch), axis=0) for op in observables]).reshape(
+            len(observables), batch.shape[1])
+
+    def density(self, batch, b):
+        return np.outer(batch[:, b], batch[:, b].conj())
+
+    def populations(self, batch):
+        return np.abs(batch) ** 2
+
+    def save_state(self, batch):
+        return {'kets': batch}
+
+    def load_state(self, arrays):
+        """ Coefficients in the eigenbasis of the saved state vectors, as returned by prepare. """
+        return self.eigenvectors.conj().T @ arrays['kets']
+
+
+def is_pure(rho, tol=1e-10):
+    """ True if the density matrix rho is a pure state. """
+    rho = sp.csr_matrix(rho)
+    return abs(np.real((rho @ rho).diagonal().sum()) - 1) < tol
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs of the walker on ensembles of many graphs (e.g. random mazes or sampled subnetworks).
+
+The master equations of small graphs are packed into block-diagonal systems, so that a single propagation solves
+many graphs at once, while larger graphs are run one per task. Tasks are distributed on a pool of processes that
+is kept alive between calls.
+"""
+
+import atexit
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+
+from .engines import PropagatorEngine
+from .objects import SQWalker, _engine, _select_method
+
+# process pools kept alive between calls of run_ensemble, one for each number of workers
+_pools = {}
+
+
+def _pool(workers):
+    if workers not in _pools:
+        _pools[workers] = ProcessPoolExecutor(max_workers=workers)
+    return _pools[workers]
+
+
+def shutdown_pools():
+    """ Shuts down the process pools of run_ensemble. """
+    for pool in _pools.values():
+        pool.shutdown()
+    _pools.clear()
+
+
+atexit.register(shutdown_pools)
+
+
+def _per_graph(value, n_graphs):
+    """ List with one value per graph from a single value or a sequence of n_graphs values. """
+    if value is None or np.ndim(value) == 0:
+        return [value] * n_graphs
+    assert len(value) == n_graphs, 'Expected one value per graph'
+    return list(value)
+
+
+def _run_block(task):
+    """ Populations (time, dim) of each graph of a block, solved as a single block-diagonal system. """
+    graphs, times, method, opts = task
+    walkers = [SQWalker(adjacency, noise_param, sink_node, sink_rate)
+               for adjacency, noise_param, _, sink_node, sink_rate in graphs]
+    dims = np.array([walker.dim for walker in walkers])
+    offsets = np.cumsum(np.r_[0, dims[:-1] ** 2])
+    # position of the populations of each graph in the concatenated vectorized density matrices
+    diagonal = np.concatenate([offset + np.arange(dim) * (dim + 1) for offset, dim in zip(offsets, dims)])
+    state = np.zeros((np.sum(dims ** 2), 1), dtype=complex)
+    state[[offset + graph[2] * (dim + 1) for offset, dim, graph in zip(offsets, dims, graphs)]] = 1.
+    if method == 'propagator':
+        # the exponential of a block-diagonal Liouvillian is block-diagonal, each block is exponentiated on its own
+        dt = times[1] - times[0] if len(times) > 1 else 0.
+        engine = PropagatorEngine(sp.block_diag([walker.propagator(dt) for walker in walkers], format='csr'), dt)
+    else:
+        engine = _engine(method, sp.block_diag([walker.liouvillian() for walker in walkers], format='csr'), times,
+                         opts)
+    populations = np.array([np.real(batch[diagonal, 0]) for batch in engine.propagate(state, times)])
+    return np.split(populations, np.cumsum(dims)[:-1], axis=1)
+
+
+def _run_single(task):
+    """ Populations (time, dim) of a single graph, with the engine selected as in run_walker. """
+    (adjacency, noise_param, initial_node, sink_node, sink_rate), times, method, opts = task
+    walker = SQWalker(adjacency, noise_param, sink_node, sink_rate)
+    method = _select_method(method, noise_param, walker.hermitian and not walker.sink_nodes, True)
+    engine = walker._engine(method, times, opts)
+    rho = sp.csr_matrix(([1.], ([initial_node], [initial_node])), shape=(walker.dim, walker.dim))
+    states = engine.propagate(engine.prepare([rho]), times)
+    return [np.array([engine.populations(batch)[:, 0] for batch in states])]
+
+
+def run_ensemble(adjacencies, noise_param, initial_nodes, times, sink_nodes=None, sink_rate=1., method=None,
+                 opts=None, small_dim=32, block_size=2 ** 16, workers=None):
+    """ Populations of the walkers on many graphs.
+
+    Graphs with at most small_dim levels are packed into block-diagonal master equations with at most block_size
+    vectorized entries, propagated together with Krylov (or with the given method among 'ode', 'krylov' and
+    'propagator'), while each of the larger graphs is run with the engine of run_walker.
+
+    Parameters
+    ----------
+    adjacencies : list of np.array or scipy.sparse matrices
+        adjacency matrices of the graphs
+    noise_param : float or list of floats
+        noise parameter, either the same for all the graphs or one per graph
+    initial_nodes : integer or list of integers
+        initial node of the walker, either the same for all the graphs or one per graph
+    times : array_like
+        times at which the populations are computed, the initial states are taken at times[0]
+    sink_nodes : None, integer or list (default None)
+        sink node(s) for all the graphs, or a list of n_graphs entries with the sink node(s) of each graph (None for
+        no sink)
+    sink_rate : float or list of floats (default 1.)
+        rate of the sinks, either the same for all the graphs or one per graph
+    method : string (default None)
+        propagation engine of run_walker, by default 'krylov' for the blocks and automatic for the larger graphs
+    opts : qutip.Options (default None)
+        options of the 'ode' engine
+    small_dim : integer (default 32)
+        largest dimension (nodes plus sinks) of the graphs packed into block-diagonal systems
+    block_size : integer (default 2**16)
+        largest size of the vectorized density matrices of a block-diagonal system, or of the dense one-step
+        propagators of its graphs with method 'propagator'
+    workers : integer (default None)
+        number of worker processes of the persistent pool, defaults to the number of cpus. With 1 worker the
+        ensemble runs in process.
+
+    Returns
+    -------
+    np.array
+        structured array with one row per graph and fields 'n_nodes', 'dim', 'noise_param', 'initial_node' and
+        'populations' (time, max dim) padded with NaN beyond the dimension of each graph
+    """
+    times = np.asarray(times, dtype=float)
+    n_graphs = len(adjacencies)
+    # a sequence of n_graphs entries gives the sink node(s) of each graph, which can mix None, integers and lists
+    if not (isinstance(sink_nodes, (list, tuple)) and len(sink_nodes) == n_graphs):
+        sink_nodes = [sink_nodes] * n_graphs
+    graphs = list(zip(adjacencies, _per_graph(noise_param, n_graphs), _per_graph(initial_nodes, n_graphs),
+                      sink_nodes, _per_graph(sink_rate, n_graphs)))
+    dims = np.array([graph[0].shape[0] + (0 if graph[3] is None else len(np.atleast_1d(graph[3])))
+                     for graph in graphs])
+
+    tasks, indices = [], []
+    block, block_indices = [], []
+    blocks = method in (None, 'ode', 'krylov', 'propagator')
+    # size of a graph in a block: its vectorized density matrix, or its dense propagator for 'propagator'
+    sizes = dims ** 4 if method == 'propagator' else dims ** 2
+    for index, (graph, dim) in enumerate(zip(graphs, dims)):
+        if not blocks or dim > small_dim:
+            tasks.append((_run_single, (graph, times, method, opts)))
+            indices.append([index])
+            continue
+        if block and sum(sizes[block_indices]) + sizes[index] > block_size:
+            tasks.append((_run_block, (block, times, method or 'krylov', opts)))
+            indices.append(block_indices)
+            block, block_indices = [], []
+        block.append(graph)
+        block_indices.append(index)
+    if block:
+        tasks.append((_run_block, (block, times, method or 'krylov', opts)))
+        indices.append(block_indices)
+
+    if workers == 1 or len(tasks) == 1:
+        outputs = [function(task) for function, task in tasks]
+    else:
+        pool = _pool(workers or os.cpu_count())
+        outputs = [future.result() for future in [pool.submit(function, task) for function, task in tasks]]
+
+    results = np.zeros(n_graphs, dtype=[('n_nodes', int), ('dim', int), ('noise_param', float), ('initial_node', int),
+                                        ('populations', float, (len(times), dims.max(initial=0)))])
+    results['n_nodes'] = [graph[0].shape[0] for graph in graphs]
+    results['dim'] = dims
+    results['noise_param'] = [graph[1] for graph in graphs]
+    results['initial_node'] = [graph[2] for graph in graphs]
+    results['populations'] = np.nan
+    for task_indices, populations in zip(indices, outputs):
+        for index, graph_populations in zip(task_indices, populations):
+            results['populations'][index, :, :dims[index]] = graph_populations
+    return results
@@ -1,8 +1,372 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
 import numpy as np
-from qutip import Qobj, basis, mesolve, Options
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+
+from .cache import OperatorCache, graph_hash
+from .profiling import WalkerStats, phase
+from .storage import NpyOutput, open_output, write_checkpoint, load_checkpoint
+from .trajectories import run_trajectories
+from .engines import (ODEEngine, KrylovEngine, PropagatorEngine, ClassicalEngine, UnitaryEngine, PackedEngine,
+                      step_propagator, packed_coherent, packed_dissipator, is_pure)
+
+PRECISIONS = {'double': np.complex128, 'single': np.complex64}
+# condition number of the restricted Liouvillian above which its solutions have less than about four digits
+_MAX_CONDITION = 1e-4 / np.finfo(float).eps
+# time step times the 1-norm of the generator above which 'krylov' is faster than 'ode'
+_KRYLOV_STEP_NORM = 8.
+
+
+def _pad(matrix, n_extra):
+    """ Pads a square sparse matrix with n_extra empty rows and columns, without any dense copy. """
+    matrix = sp.csr_matrix(matrix)
+    n = matrix.shape[0] + n_extra
+    indptr = np.pad(matrix.indptr, (0, n_extra), 'edge')
+    return sp.csr_matrix((matrix.data, matrix.indices, indptr), shape=(n, n))
+
+
+def _jump_operator(row, col, coefficient, n):
+    """ Single-entry jump operator coefficient * |row><col| on an n-dimensional space. """
+    from qutip import Qobj
+    return Qobj(sp.csr_matrix(([coefficient], ([row], [col])), shape=(n, n)))
+
+
+def _hamiltonian_superoperator(H):
+    """ Superoperator of -i[H, rho] in the column-stacking convention of QuTip. """
+    identity = sp.identity(H.shape[0], format='csr')
+    return (-1j * (sp.kron(identity, H) - sp.kron(H.T, identity))).tocsr()
+
+
+def _hamiltonian_entries(rows, cols, values, n):
+    """ Entries (rows, cols, values) of the superoperator of -i[H, rho] (see _hamiltonian_superoperator) for the
+    entries H[rows, cols] = values of an n x n matrix: -i H[i, j] at (i + n k, j + n k) from H rho and +i H[i, j] at
+    (k + n j, k + n i) from rho H, for every k. """
+    k = np.arange(n)[None, :]
+    i, j, h = rows.astype(np.int64)[:, None], cols.astype(np.int64)[:, None], values[:, None]
+    return (np.concatenate([(i + n * k).ravel(), (k + n * j).ravel()]),
+            np.concatenate([(j + n * k).ravel(), (k + n * i).ravel()]),
+            np.concatenate([np.broadcast_to(-1j * h, (len(h), n)).ravel(),
+                            np.broadcast_to(1j * h, (len(h), n)).ravel()]))
+
+
+def _dissipator(rows, cols, rates, n):
+    """ Superoperator of the Lindblad dissipator of the single-entry jumps sqrt(rate) |row><col|.
+
+    Populations follow the classical rate equation d rho[i, i] / dt = rate * rho[j, j] - escape[i] * rho[i, i]
+    while every coherence rho[a, b] decays with rate (escape[a] + escape[b]) / 2, where escape[j] is the sum of
+    the rates of the jumps leaving j.
+    """
+    row_index, col_index, data = _dissipator_entries(rows, cols, rates, n)
+    return sp.csr_matrix((data, (row_index, col_index)), shape=(n * n, n * n))
+
+
+def _dissipator_entries(rows, cols, rates, n):
+    """ Entries (rows, cols, values) of the dissipator of the single-entry jumps (see _dissipator), computed only
+    for the coherences of the nodes with jumps leaving them. """
+    escape = np.bincount(cols, weights=rates, minlength=n)
+    # only the coherences with a node that has jumps leaving it decay: the rows of these nodes, then their columns
+    # without the rows already included
+    nodes = np.flatnonzero(escape)
+    others = np.setdiff1d(np.arange(n), nodes)
+    decay = np.concatenate([-0.5 * (escape[nodes][:, None] + escape[None, :]).ravel(),
+                            -0.5 * (escape[others][:, None] + escape[nodes][None, :]).ravel()])
+    positions = np.concatenate([(nodes[:, None] + n * np.arange(n)[None, :]).ravel(),
+                                (others[:, None] + n * nodes[None, :]).ravel()])
+    decaying = decay != 0
+    data = np.concatenate([rates, decay[decaying]])
+    row_index = np.concatenate([rows * (n + 1), positions[decaying]])
+    col_index = np.concatenate([cols * (n + 1), positions[decaying]])
+    return row_index, col_index, data
+
+
+def _normalized_laplacian(adjacency, degree):
+    """ Laplacian of the classical random walk, laplacian[j, i] = adjacency[i, j] / degree[j], with the sparsity
+    pattern of adjacency.T including its explicit zeros, so that update_edges can patch it in place. """
+    inverse_degree = np.divide(1., degree, out=np.zeros(len(degree)), where=degree > 0)
+    laplacian = adjacency.T.tocsr()
+    laplacian.sort_indices()
+    laplacian.data *= np.repeat(inverse_degree, np.diff(laplacian.indptr))
+    return laplacian
+
+
+def _laplacian_jumps(laplacian):
+    """ Single-entry jumps |i><j| with unit noise parameter of a laplacian, as (rows, cols, rates) arrays. """
+    laplacian = laplacian.tocoo()
+    edges = laplacian.data > 0
+    return laplacian.row[edges], laplacian.col[edges], laplacian.data[edges]
+
+
+def _add(matrix, delta):
+    """ Sum of two sparse matrices as a new CSR matrix without the entries that cancelled out. """
+    result = (matrix + delta).tocsr()
+    result.eliminate_zeros()
+    return result
+
+
+def _entries(matrix, rows, cols):
+    """ Entries matrix[rows, cols] of a CSR matrix with sorted indices and their positions in matrix.data, found by
+    a vectorized binary search within the rows. The entries outside of the sparsity pattern are 0 at position -1.
+    """
+    lo, hi = matrix.indptr[rows].astype(np.int64), matrix.indptr[rows + 1].astype(np.int64)
+    end = hi.copy()
+    while True:
+        active = lo < hi
+        if not active.any():
+            break
+        middle = (lo + hi) // 2
+        smaller = active & (matrix.indices[np.where(active, middle, 0)] < cols)
+        lo, hi = np.where(smaller, middle + 1, lo), np.where(active & ~smaller, middle, hi)
+    found = lo < end
+    found[found] = matrix.indices[lo[found]] == cols[found]
+    positions = np.where(found, lo, -1)
+    values = np.zeros(len(positions), dtype=matrix.dtype)
+    values[found] = matrix.data[positions[found]]
+    return values, positions
+
+
+def _patch(matrix, rows, cols, values):
+    """ Sum of a CSR matrix and the entries (rows, cols, values), added in place to the data of
+    the matrix when the nonzero values are within its sparsity pattern (the entries that cancel out are kept as
+    explicit zeros), or computed as a new matrix otherwise (e.g. for a read-only matrix of an OperatorCache). """
+    matrix.sort_indices()
+    nonzero = values != 0
+    rows, cols, values = rows[nonzero], cols[nonzero], values[nonzero]
+    _, positions = _entries(matrix, rows, cols)
+    if matrix.data.flags.writeable and (positions >= 0).all():
+        np.add.at(matrix.data, positions, values.astype(matrix.dtype))
+        return matrix
+    result = _add(matrix, sp.csr_matrix((values, (rows, cols)), shape=matrix.shape))
+    result.sort_indices()
+    return result
+
+
+def _rate_matrix(rows, cols, rates, n):
+    """ Generator of the classical random walk of the single-entry jumps, with the escape rate of each node. """
+    escape = np.bincount(cols, weights=rates, minlength=n)
+    return sp.csr_matrix((rates, (rows, cols)), shape=(n, n)) - sp.diags(escape), escape
+
+
+def _pure_ensemble(rho):
+    """ Weights and kets (as columns) of a decomposition of a density matrix in pure states. """
+    rho = sp.csc_matrix(rho)
+    if is_pure(rho):
+        k = np.argmax(np.real(rho.diagonal()))
+        return np.ones(1), rho[:, k].toarray() / np.sqrt(np.real(rho[k, k]))
+    weights, kets = np.linalg.eigh(rho.toarray())
+    weights = np.clip(weights, 0., None)
+    return weights / weights.sum(), kets
+
+
+def _select_method(method, noise_param, closed, pure, step_norm=None):
+    """ Engine for the walker, by default the reduced N-dimensional engines are used in the fully classical limit
+    and in the fully quantum limit when the walk is closed (hermitian and without sinks) and the states are pure.
+    The reduced engines are only valid in their limits, so a ValueError is raised if they are requested elsewhere.
+
+    Otherwise 'ode' is used, unless step_norm (a function returning the time step times the 1-norm of the
+    generator, only called in this case) shows a coarse time grid on which 'krylov' is faster (see KrylovEngine).
+    """
+    if method == 'classical' and noise_param != 1:
+        raise ValueError("The 'classical' engine requires a fully classical walker (noise_param = 1)")
+    if method == 'unitary' and not (noise_param == 0 and closed and pure):
+        raise ValueError("The 'unitary' engine requires a fully quantum walker (noise_param = 0) with a hermitian "
+                         "adjacency matrix, no sinks and pure initial states")
+    if method is not None:
+        return method
+    if noise_param == 1:
+        return 'classical'
+    if noise_param == 0 and closed and pure:
+        return 'unitary'
+    if step_norm is not None and step_norm() >= _KRYLOV_STEP_NORM:
+        return 'krylov'
+    return 'ode'
+
+
+def _options(opts, **defaults):
+    """ QuTip's Options with the given defaults if opts is None. """
+    if opts is None:
+        from qutip import Options
+        opts = Options(**defaults)
+    return opts
+
+
+def _engine(method, liouvillian, times, opts, max_bytes=None):
+    """ Propagation engine for a Liouvillian, method is one of 'ode', 'krylov' or 'propagator'. max_bytes limits the
+    states of a block of the 'krylov' engine. """
+    if method == 'ode':
+        return ODEEngine(liouvillian, _options(opts))
+    elif method == 'krylov':
+        return KrylovEngine(liouvillian, max_bytes=max_bytes)
+    elif method == 'propagator':
+        dt = times[1] - times[0] if len(times) > 1 else 0.
+        return PropagatorEngine(step_propagator(liouvillian, dt), dt)
+    raise ValueError("Unknown method '%s', use one of 'ode', 'krylov' or 'propagator'" % method)
+
+
+def _hermite_crossing(t0, t1, y0, y1, dy0, dy1, threshold):
+    """ First time in [t0, t1] at which the cubic Hermite interpolant of the values y0, y1 and derivatives dy0, dy1
+    reaches threshold, falling back to linear interpolation if the cubic does not cross it. """
+    h = t1 - t0
+    # interpolant in s = (t - t0) / h as a cubic polynomial, highest degree first
+    coefficients = [2 * y0 - 2 * y1 + h * (dy0 + dy1), 3 * (y1 - y0) - h * (2 * dy0 + dy1), h * dy0, y0 - threshold]
+    roots = np.roots(coefficients)
+    roots = np.real(roots[(np.abs(np.imag(roots)) < 1e-9) & (np.real(roots) >= -1e-9) & (np.real(roots) <= 1 + 1e-9)])
+    if len(roots):
+        s = np.clip(roots.min(), 0., 1.)
+    else:
+        s = (threshold - y0) / (y1 - y0) if y1 != y0 else 1.
+    return t0 + s * h
+
+
+def _sensitivities(adjoint, state, h_rows, h_cols, j_rows, j_cols):
+    """ Derivatives of the bilinear form vec(adjoint) . L vec(state) with respect to the entries H[a, b] of the
+    Hamiltonian of the coherent part -i[H, rho] and to the rates of the single-entry jumps |i><j|, for (dim, dim)
+    matrices adjoint and state. """
+    product = adjoint * state
+    # the anticommutator of a jump from j acts on the row and on the column j
+    rows, cols = product.sum(axis=1), product.sum(axis=0)
+    coherent = -1j * (np.einsum('ec,ec->e', adjoint[h_rows], state[h_cols]) -
+                      np.einsum('ce,ce->e', state[:, h_rows], adjoint[:, h_cols]))
+    jumps = np.diagonal(adjoint)[j_rows] * np.diagonal(state)[j_cols] - 0.5 * (rows[j_cols] + cols[j_cols])
+    return coherent, jumps
+
+
+def _condition(matrix, lu):
+    """ Estimate of the 1-norm condition number of a matrix from the solves of its (possibly incomplete) LU
+    factorization. """
+    inverse = spla.LinearOperator(matrix.shape, matvec=lu.solve, rmatvec=lambda x: lu.solve(x, trans='H'),
+                                  dtype=matrix.dtype)
+    return spla.norm(matrix, 1) * spla.onenormest(inverse)
+
+
+def _factorize(matrix):
+    """ Sparse LU factorization of the Liouvillian restricted to the graph (or of its transpose).
+
+    splu only fails for exactly singular matrices, while dark states or parts of the graph disconnected from the
+    sinks usually leave the Liouvillian singular only up to rounding errors, and its solutions meaningless. So the
+    Liouvillian is also rejected when its estimated condition number leaves less than about four significant digits.
+    """
+    try:
+        lu = spla.splu(matrix)
+    except RuntimeError:
+        lu = None
+    if lu is None or _condition(matrix, lu) > _MAX_CONDITION:
+        raise ValueError('The Liouvillian restricted to the graph is singular: part of the population never reaches '
+                         'the sink (e.g. dark states of a fully quantum walker)')
+    return lu
+
+
+def _simpson_weights(steps, h):
+    """ Weights of the composite Simpson rule on steps + 1 points spaced by h, steps being even. """
+    weights = np.ones(steps + 1)
+    weights[1:-1:2], weights[2:-1:2] = 4., 2.
+    return weights * h / 3
+
+
+def _collect(engine, states, times, observables, initial_states, opts, solver):
+    """ Stores the batches of states yielded by an engine in one QuTip Result per initial state, with the same
+    conventions of mesolve. """
+    from qutip import Qobj
+    from qutip.solver import Result
+
+    outputs = []
+    for initial_state in initial_states:
+        output = Result()
+        output.solver = solver
+        output.times = times
+        output.num_expect = len(observables)
+        output.expect = [np.zeros(len(times)) if isinstance(op, Qobj) and op.isherm and initial_state.isherm
+                         else np.zeros(len(times), dtype=complex) for op in observables]
+        outputs.append(output)
+    # as in mesolve, states are stored when there are no observables to track
+    store_states = opts.store_states or len(observables) == 0
+    need_qobj_state = store_states or any(not isinstance(op, Qobj) for op in observables)
+    operators = engine.observables([op.data for op in observables if isinstance(op, Qobj)])
+
+    batch = None
+    for t_idx, (t, batch) in enumerate(zip(times, states)):
+        expect = iter(engine.expect(operators, batch))
+        for m, op in enumerate(observables):
+            values = next(expect) if isinstance(op, Qobj) else None
+            for b, output in enumerate(outputs):
+                if values is not None:
+                    output.expect[m][t_idx] = np.real(values[b]) if np.isrealobj(output.expect[m]) else values[b]
+        if need_qobj_state:
+            for b, output in enumerate(outputs):
+                rho_t = Qobj(engine.density(batch, b), dims=initial_states[b].dims)
+                if store_states:
+                    output.states.append(rho_t)
+                for m, op in enumerate(observables):
+                    if not isinstance(op, Qobj):
+                        output.expect[m][t_idx] = op(t, rho_t)
+
+    if opts.store_final_state and batch is not None:
+        for b, output in enumerate(outputs):
+            output.final_state = Qobj(engine.density(batch, b), dims=initial_states[b].dims,
+                                      isherm=initial_states[b].isherm or None)
+    return outputs
+
+
+def _stream(engine, states, times, observables, initial_states, chunk_size):
+    """ Populations (time, batch, dim) and expectation values (time, batch, observable) of the states yielded by an
+    engine, in chunks of at most chunk_size time samples. The last batch of states is yielded with each chunk. """
+    from qutip import Qobj
+
+    operators = engine.observables([op.data for op in observables if isinstance(op, Qobj)])
+    complex_expect = any(not (isinstance(op, Qobj) and op.isherm) for op in observables)
+    steps = zip(times, states)
+    while True:
+        chunk = list(islice(steps, chunk_size))
+        if not chunk:
+            return
+        chunk_times = np.array([t for t, _ in chunk])
+        populations = np.array([engine.populations(batch).T for _, batch in chunk])
+        expect = np.zeros((len(chunk), len(initial_states), len(observables)),
+                          dtype=complex if complex_expect else float)
+        for t_idx, (t, batch) in enumerate(chunk):
+            values = iter(engine.expect(operators, batch))
+            for m, op in enumerate(observables):
+                if isinstance(op, Qobj):
+                    expect[t_idx, :, m] = next(values) if complex_expect else np.real(next(values))
+                else:
+                    expect[t_idx, :, m] = [op(t, Qobj(engine.density(batch, b), dims=state.dims))
+                                           for b, state in enumerate(initial_states)]
+        yield chunk_times, populations, expect, chunk[-1][1]
+
+
+# Liouvillian components shared by the workers of a noise sweep, set once per process by _init_sweep
+_sweep_context = {}
+
+
+def _init_sweep(components, jumps, eigensystem, initial_state, times, observables, opts, method):
+    _sweep_context.update(components=components, jumps=jumps, eigensystem=eigensystem, initial_state=initial_state,
+                          times=times, observables=observables, opts=opts, method=method)
+
+
+def _sweep_point(noise_param):
+    """ Expectation values (time x observable) of the walker with the given noise parameter. """
+    times, initial_state = _sweep_context['times'], _sweep_context['initial_state']
+    method = _select_method(_sweep_context['method'], noise_param, _sweep_context['eigensystem'] is not None, True)
+    if method == 'classical':
+        (rows, cols, rates), (sink_rows, sink_cols, sink_rates) = _sweep_context['jumps']
+        engine = ClassicalEngine(*_rate_matrix(np.concatenate([rows, sink_rows]), np.concatenate([cols, sink_cols]),
+                                               np.concatenate([noise_param * rates, sink_rates]),
+                                               initial_state.shape[0]))
+    elif method == 'unitary':
+        eigenvalues, eigenvectors = _sweep_context['eigensystem']
+        engine = UnitaryEngine((1 - noise_param) * eigenvalues, eigenvectors)
+    else:
+        coherent, classical, sink = _sweep_context['components']
+        liouvillian = ((1 - noise_param) * coherent + noise_param * classical + sink).tocsr()
+        engine = _engine(method, liouvillian, times, _sweep_context['opts'])
+    states = engine.propagate(engine.prepare([initial_state.data]), times)
+    result, = _collect(engine, states, times, _sweep_context['observables'], [initial_state], _sweep_context['opts'],
+                       _sweep_context['method'])
+    return np.array(result.expect).T
 
 
 class SQWalker(object):
@@ -10,6 +374,25 @@ class SQWalker(object):
     Stochastic quantum walker on QuTip.
     Class containing an open quantum system described by a Lindblad equation obtained from the adjacency matrix.
 
+    The adjacency matrix can be either a dense numpy array or a scipy.sparse matrix: all the operators are built
+    with vectorized sparse operations, so the construction scales with the number of edges of the graph.
+
+    Operators that only depend on the graph (the Liouvillian components and the eigensystem of the adjacency) can
+    be stored in a persistent OperatorCache shared by processes and jobs, passing either the cache or its
+    directory as the cache argument.
+
+    Passing stats=True (or a WalkerStats object) the walker records the wall time of the construction phases and
+    of the runs, the sizes of the operators and the counters of the solvers in self.stats (see WalkerStats).
+
+    For large graphs the memory of the runs can be reduced with precision='single', which builds the superoperators
+    in complex64 and runs the 'krylov', 'propagator', 'classical' and 'unitary' engines in single precision (the
+    'ode' engine and the transfer efficiency are always computed in double precision), and with packed=True (only for
+    symmetric adjacency matrices, whose dynamics preserves hermiticity), which stores the hermitian density matrices
+    as n**2 real numbers propagated by a real generator built directly in the real type of the precision, halving
+    the size of the states and of the generator used by the vectorized engines. The peak memory of a run decreases
+    less, since the engines hold their own copies of the generator, e.g. on a 400 node maze by about 35% for 'ode'
+    and 25% for 'krylov'.
+
     Theoretical model:
     Whitfield, J. D., Rodríguez-Rosario, C. A., & Aspuru-Guzik, A. (2010).
     Quantum stochastic walks: A generalization of classical random walks and quantum walks.
@@ -17,52 +400,448 @@ class SQWalker(object):
 
     @author: Lorenzo Buffoni
     """
-    def __init__(self, adjacency, noise_param=0., sink_node=None, sink_rate=1.):
-        self.adjacency = adjacency
+    def __init__(self, adjacency, noise_param=0., sink_node=None, sink_rate=1., cache=None, stats=None,
+                 precision='double', packed=False):
+        assert precision in PRECISIONS, "The precision must be one of %s" % ', '.join(PRECISIONS)
+        self.dtype = PRECISIONS[precision]
+        self.packed = packed
+        self.stats = WalkerStats() if stats is True else stats or None
+        # the adjacency matrix exposed by self.adjacency, the one given by the caller until update_edges
+        self._public_adjacency = adjacency
         self.N = adjacency.shape[0]
-        # degree vector representing the connectivity degree of each node
-        self.degree = np.sum(adjacency, axis=0)
-        # normalized laplacian of the classical random walk
-        self.laplacian = np.array([[self.adjacency[i, j] / self.degree[j] if self.degree[j] > 0 else 0
-                                    for i in range(self.N)] for j in range(self.N)])
+        with phase(self.stats, 'laplacian'):
+            # a copy, since update_edges changes the weights in place
+            self._adjacency = sp.csr_matrix(adjacency, dtype=float, copy=True)
+            self._adjacency.sort_indices()
+            # degree vector representing the connectivity degree of each node
+            self.degree = np.asarray(self._adjacency.sum(axis=0)).ravel()
+            # normalized laplacian of the classical random walk, laplacian[j, i] = adjacency[i, j] / degree[j]
+            self.laplacian = _normalized_laplacian(self._adjacency, self.degree)
+        self.hermitian = abs(self._adjacency - self._adjacency.T).max() == 0 if self._adjacency.nnz else True
+        if packed and not self.hermitian:
+            raise ValueError('Packed states require a hermitian adjacency matrix')
         self.sink_node = sink_node
-        # TODO: implement multiple sinks
+        # every sink node is connected to its own absorbing level N + k
+        if sink_node is None:
+            self.sink_nodes = []
+        else:
+            self.sink_nodes = list(np.atleast_1d(sink_node))
+        self.cache = OperatorCache(cache) if isinstance(cache, str) else cache
+        self._components = None
+        self._eigensystem = None
         self.create_walker_from_graph(noise_param, sink_rate)
 
+    @property
+    def adjacency(self):
+        """ Adjacency matrix of the walker, the one given to the constructor or, after update_edges, a sparse copy
+        of the updated one. The walker keeps its own copy, so changing this matrix does not change the walker. """
+        if self._public_adjacency is None:
+            self._public_adjacency = self._adjacency.copy()
+            # the removed edges are kept as explicit zeros only by the walker
+            self._public_adjacency.eliminate_zeros()
+        return self._public_adjacency
+
+    @property
+    def dim(self):
+        """ Dimension of the Hilbert space of the walker (nodes plus the sinks if present). """
+        return self.N + len(self.sink_nodes)
+
     def create_walker_from_graph(self, noise_param, sink_rate):
         """ Creates the Hamiltonian and the Lindblad operators for the walker given an adjacency matrix
         and other parameters.
 
+        The Lindblad operators are single-entry jumps |i><j| and are stored as (rows, cols, rates) arrays,
+        the list of QuTip collapse operators is only built on demand by `classical_hamiltonian`.
+
         Parameters
         ----------
         noise_param : float between 0 and 1
             parameter controlling the 'quantumness' of the system (0 is fully quantum, 1 is fully classical)
-        sink_rate : float between 0 and 1
-            if a sink is present the trasfer rate from the sink_node to the sink (defaults to 1.)
+        sink_rate : float between 0 and 1, or list of floats
+            if a sink is present the trasfer rate from the sink_node to the sink (defaults to 1.), with multiple
+            sinks either a single rate for all of them or one rate per sink
          """
         self.p = noise_param
-        if self.sink_node is not None:
+        self.sink_rate = sink_rate
+        n_sinks = len(self.sink_nodes)
+        with phase(self.stats, 'jumps'):
+            # jump |i><j| with rate laplacian[i, j], to be multiplied by the noise parameter
+            self._jumps = _laplacian_jumps(self.laplacian)
             # TODO: add check for directed graphs
-            H = Qobj((1 - self.p) * np.pad(self.adjacency, [(0, 1), (0, 1)], 'constant'))
-            L = [np.sqrt(self.p * self.laplacian[i, j]) * (basis(self.N + 1, i) * basis(self.N + 1, j).dag())
-                for i in range(self.N) for j in range(self.N) if self.laplacian[i, j] > 0]
-            S = np.zeros([self.N + 1, self.N + 1])  # transition matrix to the sink
-            S[self.N, self.sink_node] = np.sqrt(2 * sink_rate)
-            L.append(Qobj(S))
+            # transitions to the sinks
+            rates = 2. * np.broadcast_to(np.asarray(sink_rate, dtype=float), (n_sinks,))
+            if self._components is not None and not np.array_equal(rates, self._sink_jumps[2]):
+                self._components = None
+            self._sink_jumps = (self.N + np.arange(n_sinks), np.array(self.sink_nodes, dtype=int), rates)
+        with phase(self.stats, 'hamiltonian'):
+            self._hamiltonian = (1 - self.p) * _pad(self._adjacency, n_sinks)
+        self._quantum_hamiltonian = None
+        if self.stats is not None:
+            self.stats.update(nodes=self.N, edges=self._adjacency.nnz, dim=self.dim,
+                              hamiltonian_nnz=self._hamiltonian.nnz,
+                              jumps=len(self._graph_jumps[0]) + n_sinks)
+        self._collapse_operators = None
+        self._liouvillian = None
+        self._packed_liouvillian = None
+        self._propagators = {}
+        self._absorption = None
+        self._absorption_guess = None
+        self._preconditioner = None
+
+    def update_edges(self, changes, symmetric=True):
+        """ Changes the weights of some edges of the graph, patching the operators of the walker in place.
+
+        When the changed edges are already in the graph (or were removed by an earlier update, which keeps them as
+        explicit zeros) the weights, the Hamiltonian and the laplacian rows of the nodes whose degree changes are
+        overwritten in place, and since the Liouvillian is linear in the adjacency matrix and in the jump rates the
+        superoperators of the differences, which only involve the changed nodes and their neighbours, are added to
+        the data of the cached Liouvillian (or of its components, if it was not built yet). New edges change the
+        sparsity pattern, so the operators are rebuilt with them instead. The solutions of the last
+        transfer_efficiency and, with solver='iterative', its incomplete factorization are the initial guess
+        and the preconditioner of the next one. The eigensystem, the propagators and the QuTip collapse operators are
+        rebuilt on demand.
+
+        After an update self.adjacency is a sparse copy of the updated adjacency matrix, which is only made when it is
+        accessed.
+
+        Parameters
+        ----------
+        changes : dict {(i, j): weight} or list of (i, j, weight)
+            new weights of the adjacency matrix, a weight 0 removes the edge
+        symmetric : bool (default True)
+            also set adjacency[j, i] = weight, as for the undirected graphs (e.g. the links of a maze)
+        """
+        if isinstance(changes, dict):
+            changes = [(i, j, weight) for (i, j), weight in changes.items()]
+        if len(changes) == 0:
+            return
+        with phase(self.stats, 'update_edges'):
+            rows, cols, weights = (np.asarray(column) for column in zip(*changes))
+            rows, cols, weights = rows.astype(int), cols.astype(int), weights.astype(float)
+            if symmetric:
+                # each change followed by its mirror, so that the order of the changes is kept
+                rows, cols = np.stack([rows, cols], axis=1).ravel(), np.stack([cols, rows], axis=1).ravel()
+                weights = np.repeat(weights, 2)
+            # the last change of each entry wins
+            _, last = np.unique((rows * self.N + cols)[::-1], return_index=True)
+            last = len(rows) - 1 - last
+            rows, cols, weights = rows[last], cols[last], weights[last]
+
+            n_sinks = len(self.sink_nodes)
+            old_weights, positions = _entries(self._adjacency, rows, cols)
+            delta = sp.csr_matrix((weights - old_weights, (rows, cols)), shape=(self.N, self.N))
+            # laplacian[j, i] = adjacency[i, j] / degree[j], only the rows of the changed columns are affected
+            affected = np.unique(cols)
+            old_rows = self.laplacian[affected]
+            if (positions >= 0).all():
+                self._adjacency.data[positions] = weights
+                # the Hamiltonian and the laplacian keep the sparsity pattern of the adjacency matrix
+                self._hamiltonian.data[positions] = (1 - self.p) * weights
+                starts, stops = self.laplacian.indptr[affected], self.laplacian.indptr[affected + 1]
+                owner = np.repeat(np.arange(len(affected)), stops - starts)
+                entries = np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)])
+                column, _ = _entries(self._adjacency, self.laplacian.indices[entries], affected[owner])
+                self.degree[affected] = np.bincount(owner, weights=column, minlength=len(affected))
+                inverse_degree = np.divide(1., self.degree[affected], out=np.zeros(len(affected)),
+                                           where=self.degree[affected] > 0)
+                self.laplacian.data[entries] = column * inverse_degree[owner]
+            else:
+                self._adjacency = _add(self._adjacency, delta)
+                self._adjacency.sort_indices()
+                self.degree = np.asarray(self._adjacency.sum(axis=0)).ravel()
+                self.laplacian = _normalized_laplacian(self._adjacency, self.degree)
+                self._hamiltonian = (1 - self.p) * _pad(self._adjacency, n_sinks)
+            self._public_adjacency = None
+            self._jumps = None
+            if self.hermitian:
+                # only the changed entries can break the symmetry
+                mirror, _ = _entries(self._adjacency, cols, rows)
+                self.hermitian = bool(np.all(mirror == weights))
+            else:
+                self.hermitian = abs(self._adjacency - self._adjacency.T).max() == 0 if self._adjacency.nnz else True
+
+            self._quantum_hamiltonian = None
+            if self._liouvillian is not None or self._components is not None:
+                # differences of the jump rates |j><i| of the changed rows, the jumps are the positive entries of the
+                # laplacian
+                rates = (self.laplacian[affected].maximum(0) - old_rows.maximum(0)).tocoo()
+                delta = delta.tocoo()
+                d_coherent = _hamiltonian_entries(delta.row, delta.col, delta.data, self.dim)
+                d_classical = _dissipator_entries(affected[rates.row], rates.col, rates.data, self.dim)
+                if self._liouvillian is not None:
+                    # the components are rebuilt (or loaded from the cache) only if p changes
+                    rows, cols, values = (np.concatenate([coherent, classical])
+                                          for coherent, classical in zip(d_coherent, d_classical))
+                    values[:len(d_coherent[2])] *= 1 - self.p
+                    values[len(d_coherent[2]):] *= self.p
+                    self._liouvillian = _patch(self._liouvillian, rows, cols, values)
+                    self._components = None
+                else:
+                    coherent, classical, sink = self._components
+                    self._components = (_patch(coherent, *d_coherent), _patch(classical, *d_classical), sink)
+            self._collapse_operators = None
+            self._packed_liouvillian = None
+            self._eigensystem = None
+            self._propagators = {}
+            if self._absorption is not None:
+                self._absorption_guess = self._absorption
+            self._absorption = None
+
+    def liouvillian_components(self):
+        """ Decomposition of the Liouvillian as (1 - p) * coherent + p * classical + sink.
+
+        The components do not depend on the noise parameter and are cached on the walker, so that changing p only
+        requires recombining them.
+
+        Returns
+        -------
+        (scipy.sparse.csr_matrix, scipy.sparse.csr_matrix, scipy.sparse.csr_matrix)
+            coherent part -i[A, rho], classical dissipator of the graph jumps and dissipator of the sinks.
+        """
+        if self._components is None:
+            names = ('coherent', 'classical', 'sink')
+            if self.cache is not None:
+                # plain ints and floats, the repr of numpy scalars changes across the versions of numpy
+                key = graph_hash(self._adjacency, [int(k) for k in self.sink_nodes],
+                                 [float(r) for r in self._sink_jumps[2]], np.dtype(self.dtype).name)
+                components = tuple(self.cache.load_sparse(key, name) for name in names)
+                if all(component is not None for component in components):
+                    self._components = components
+                    return components
+            hamiltonian = _pad(self._adjacency, len(self.sink_nodes))
+            self._components = (_hamiltonian_superoperator(hamiltonian).astype(self.dtype),
+                                _dissipator(*self._graph_jumps, self.dim).astype(self.real_dtype),
+                                _dissipator(*self._sink_jumps, self.dim).astype(self.real_dtype))
+            if self.cache is not None:
+                for name, component in zip(names, self._components):
+                    self.cache.store_sparse(key, name, component)
+        return self._components
+
+    @property
+    def _graph_jumps(self):
+        """ Jumps of the graph with unit noise parameter as (rows, cols, rates) arrays, rebuilt from the laplacian
+        on demand after update_edges. """
+        if self._jumps is None:
+            self._jumps = _laplacian_jumps(self.laplacian)
+        return self._jumps
+
+    @property
+    def real_dtype(self):
+        """ Real type of the precision of the walker. """
+        return np.finfo(self.dtype).dtype
+
+    @property
+    def quantum_hamiltonian(self):
+        """ Hamiltonian of the walker as a QuTip object, built on demand. """
+        if self._quantum_hamiltonian is None:
+            from qutip import Qobj
+            self._quantum_hamiltonian = Qobj(self._hamiltonian)
+        return self._quantum_hamiltonian
+
+    @property
+    def classical_hamiltonian(self):
+        """ List of the Lindblad operators of the walker as QuTip objects. """
+        if self._collapse_operators is None:
+            with phase(self.stats, 'jump_operators'):
+                rows, cols, rates = self._graph_jumps
+                L = [_jump_operator(i, j, np.sqrt(self.p * rate), self.dim) for i, j, rate in zip(rows, cols, rates)]
+                L += [_jump_operator(i, j, np.sqrt(rate), self.dim) for i, j, rate in zip(*self._sink_jumps)]
+            self._collapse_operators = L
+        return self._collapse_operators
+
+    def liouvillian(self):
+        """ Superoperator of the Lindblad master equation as a sparse CSR matrix acting on vectorized
+        (column-stacked) density matrices.
+
+        Since every Lindblad operator is a single-entry jump the superoperator is assembled directly from the
+        Hamiltonian and the jump rates, it is cached on the walker until the parameters change.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+            (dim**2, dim**2) Liouvillian of the walker.
+        """
+        if self._liouvillian is None:
+            with phase(self.stats, 'liouvillian'):
+                coherent, classical, sink = self.liouvillian_components()
+                L = sink
+                if self.p != 1:
+                    L = L + (1 - self.p) * coherent
+                if self.p != 0:
+                    L = L + self.p * classical
+                self._liouvillian = L.tocsr()
+                self._liouvillian.sort_indices()
+            if self.stats is not None:
+                self.stats.update(liouvillian_dim=self._liouvillian.shape[0], liouvillian_nnz=self._liouvillian.nnz)
+        return self._liouvillian
+
+    def packed_liouvillian(self):
+        """ Real generator of the packed density matrices (see engines.packing), cached on the walker. It is built
+        directly from the Hamiltonian and the jump rates in the real type of the precision of the walker, without
+        the complex Liouvillian.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+            (dim**2, dim**2) real generator of the packed density matrices
+        """
+        if not self.hermitian:
+            # the coherent part of a directed graph does not preserve the hermiticity of the states
+            raise ValueError('Packed states require a hermitian adjacency matrix')
+        if self._packed_liouvillian is None:
+            with phase(self.stats, 'liouvillian'):
+                rows, cols, rates = self._graph_jumps
+                L = packed_dissipator(*self._sink_jumps, self.dim, dtype=self.real_dtype)
+                if self.p != 1:
+                    L = L + packed_coherent(self._hamiltonian, dtype=self.real_dtype)
+                if self.p != 0:
+                    L = L + packed_dissipator(rows, cols, self.p * rates, self.dim, dtype=self.real_dtype)
+                self._packed_liouvillian = L.tocsr()
+            if self.stats is not None:
+                self.stats.update(liouvillian_dim=self._packed_liouvillian.shape[0],
+                                  liouvillian_nnz=self._packed_liouvillian.nnz)
+        return self._packed_liouvillian
+
+    def propagator(self, dt):
+        """ Dense propagator exp(L dt) over a single time step (of the packed generator for a packed walker), cached
+        for each dt.
+
+        The propagator has (dim**2, dim**2) entries, so it is only suitable for small graphs.
+        """
+        if dt not in self._propagators:
+            liouvillian = self.packed_liouvillian() if self.packed else self.liouvillian()
+            with phase(self.stats, 'propagator'):
+                self._propagators[dt] = step_propagator(liouvillian, dt)
+        return self._propagators[dt]
+
+    def rate_matrix(self):
+        """ Generator of the populations in the fully classical limit and escape rate of each node.
+
+        Returns
+        -------
+        (scipy.sparse.csr_matrix, np.array)
+            (dim, dim) rate matrix W such that dP/dt = W P, and total rate of the jumps leaving each node
+        """
+        (rows, cols, rates), (sink_rows, sink_cols, sink_rates) = self._graph_jumps, self._sink_jumps
+        rate_matrix, escape = _rate_matrix(np.concatenate([rows, sink_rows]), np.concatenate([cols, sink_cols]),
+                                           np.concatenate([self.p * rates, sink_rates]), self.dim)
+        return rate_matrix.astype(self.real_dtype), escape
+
+    def eigensystem(self):
+        """ Cached eigendecomposition of the (hermitian) adjacency matrix, used by the fully quantum engine.
+
+        Returns
+        -------
+        (np.array, np.array)
+            eigenvalues and eigenvectors (as columns) of the adjacency matrix
+        """
+        assert self.hermitian, 'The eigensystem is only available for hermitian adjacency matrices'
+        if self._eigensystem is None:
+            with phase(self.stats, 'eigensystem'):
+                key = graph_hash(self._adjacency, self.real_dtype.name) if self.cache is not None else None
+                arrays = self.cache.load_arrays(key, 'eigensystem') if key else None
+                if arrays is not None:
+                    self._eigensystem = (arrays['eigenvalues'], arrays['eigenvectors'])
+                else:
+                    self._eigensystem = np.linalg.eigh(self._adjacency.toarray().astype(self.real_dtype))
+                    if key:
+                        self.cache.store_arrays(key, 'eigensystem', dict(zip(('eigenvalues', 'eigenvectors'),
+                                                                             self._eigensystem)))
+        return self._eigensystem
+
+    def _engine(self, method, times, opts, max_bytes=None):
+        """ Propagation engine of the walker for one of the methods of run_walker. """
+        if method == 'classical':
+            return ClassicalEngine(*self.rate_matrix())
+        elif method == 'unitary':
+            assert self.hermitian and not self.sink_nodes, 'The unitary engine requires a closed hermitian walker'
+            eigenvalues, eigenvectors = self.eigensystem()
+            return UnitaryEngine((1 - self.p) * eigenvalues, eigenvectors)
+        elif method == 'propagator':
+            dt = times[1] - times[0] if len(times) > 1 else 0.
+            engine = PropagatorEngine(self.propagator(dt), dt)
         else:
-            H = Qobj((1 - self.p) * self.adjacency)
-            L = [np.sqrt(self.p * self.laplacian[i, j]) * (basis(self.N, i) * basis(self.N, j).dag())
-                 for i in range(self.N) for j in range(self.N) if self.laplacian[i, j] > 0]
-        self.quantum_hamiltonian = H
-        self.classical_hamiltonian = L
+            engine = _engine(method, self.packed_liouvillian() if self.packed else self.liouvillian(), times, opts,
+                             max_bytes)
+        return PackedEngine(engine, self.dim) if self.packed else engine
+
+    def _initial_state(self, initial_quantum_state):
+        """ Density matrix of the walker (including the sinks) from a Qobj or the index of the initial node. """
+        from qutip import Qobj, ket2dm
 
-    def run_walker(self, initial_quantum_state, time_samples, dt=1e-2, observables=[], opts=Options(store_states=False, store_final_state=True)):
-        """ Run the walker on the graph. The solver for the Lindblad master equation is mesolve from QuTip.
+        # if the initial quantum state is specified as a node create the corresponding density matrix
+        if isinstance(initial_quantum_state, (int, np.integer)):
+            initial_quantum_state = Qobj(sp.csr_matrix(([1.], ([initial_quantum_state], [initial_quantum_state])),
+                                                       shape=(self.N, self.N)))
+        elif initial_quantum_state.isket:
+            initial_quantum_state = ket2dm(initial_quantum_state)
+
+        # if sinks are present add them to the density matrix of the system
+        if self.sink_nodes and initial_quantum_state.shape == (self.N, self.N):
+            initial_quantum_state = Qobj(_pad(initial_quantum_state.data, len(self.sink_nodes)))
+        return initial_quantum_state
+
+    def _step_norm(self, times):
+        """ Time step of a uniform grid of times (0 otherwise) times the 1-norm of the generator of the vectorized
+        engines. """
+        steps = np.diff(times)
+        if len(steps) == 0 or not np.allclose(steps, steps[0]):
+            return 0.
+        return steps[0] * spla.norm(self.packed_liouvillian() if self.packed else self.liouvillian(), 1)
+
+    def _prepare_run(self, initial_quantum_state, times, opts, method, saved=None, max_bytes=None):
+        """ Initial density matrices, engine and generator of the states of a run of the walker over times. A resumed
+        run starts from the state saved by the engine of its checkpoint, while its initial states only provide the
+        number and the dimensions of the results. """
+        batch = isinstance(initial_quantum_state, (list, tuple, np.ndarray))
+        initial_states = [self._initial_state(state)
+                          for state in (initial_quantum_state if batch else [initial_quantum_state])]
+        if saved is None:
+            method = _select_method(method, self.p, self.hermitian and not self.sink_nodes,
+                                    all(is_pure(state.data) for state in initial_states),
+                                    lambda: self._step_norm(times))
+        engine = self._engine(method, times, opts, max_bytes)
+        states = engine.propagate(engine.prepare([state.data for state in initial_states]) if saved is None
+                                  else engine.load_state(saved), times)
+        if self.stats is not None:
+            states = self.stats.timed(states, 'propagate')
+        return batch, initial_states, method, engine, states
+
+    def run_walker(self, initial_quantum_state, time_samples, dt=1e-2, observables=[], opts=None,
+                   method=None, chunk_size=1000, callback=None, output=None, ntraj=500, workers=None, seed=None,
+                   stats=None, start_time=0., checkpoint=None, checkpoint_interval=1000, max_bytes=None):
+        """ Run the walker on the graph. The Lindblad master equation is integrated with one of the engines:
+
+        - 'ode': adaptive zvode integrator, the same used by mesolve from QuTip;
+        - 'krylov': Krylov propagation with scipy's expm_multiply over the uniform time grid, faster than 'ode' only
+          for coarse grids, whose time step is several times the inverse 1-norm of the Liouvillian (see KrylovEngine);
+        - 'propagator': repeated application of the cached one-step propagator exp(L dt), for small graphs;
+        - 'classical': rate equation on the N populations, only for the fully classical walker (p = 1);
+        - 'unitary': N-dimensional state vectors evolved in the cached eigenbasis of the adjacency matrix, only for
+          the fully quantum walker (p = 0) without sinks and with pure initial states;
+        - 'trajectories': average over ntraj quantum trajectories with N-dimensional state vectors, run on a pool of
+          processes, for graphs too large for density matrices. Only the populations and the expectation values of
+          hermitian observables are computed, together with their standard errors.
+
+        By default the 'classical' and 'unitary' engines are selected automatically in their limits, otherwise 'ode'
+        or, when dt times the 1-norm of the Liouvillian is at least 8, 'krylov'. Requesting the 'classical' and
+        'unitary' engines outside of their limits raises a ValueError.
+
+        When a callback or an output is given the walker runs in streaming mode: populations and observables are
+        computed in chunks of chunk_size time samples, passed to the callback and written to the output as soon as
+        they are available, so that only one chunk is kept in memory (see also stream_walker).
+
+        When a checkpoint path is given the run is also streamed, in chunks of checkpoint_interval time samples, and
+        after every chunk the state of the engine at the last time sample (e.g. the populations and the coherences
+        of the initial states for 'classical', or the state vectors for 'unitary') is saved to the checkpoint
+        together with the expectation values computed so far and the time grid. An interrupted run is continued with
+        resume_walker.
 
         Parameters
         ----------
-        initial_quantum_state : qutip.qobj.Qobj or integer specifying the initial node
-            quantum state of the system at the beginning of the simulation
+        initial_quantum_state : qutip.qobj.Qobj or integer specifying the initial node, or a list of them
+            quantum state of the system at the beginning of the simulation. A list of initial states is
+            propagated together as a single batched evolution, exploiting the linearity of the master equation.
         time_samples : integer
             number of time samples considered in the time equation
         dt : float (default 10**-2)
@@ -70,24 +849,620 @@ class SQWalker(object):
         observables: list (default empty)
             list of observables to track during the dynamics.
         opts: qutip.Options (default None)
+            options for QuTip's solver mesolve, by default the states are not stored except for the final one.
+        method : string (default None)
+            propagation engine, one of 'ode', 'krylov', 'propagator', 'classical', 'unitary' or 'trajectories'
+            (which is configured by ntraj, workers and seed).
+        chunk_size : integer (default 1000)
+            number of time samples of each chunk in streaming mode
+        callback : function (default None)
+            called in streaming mode as callback(times, populations, expect) for each chunk, with arrays of shape
+            (chunk,), (chunk, batch, dim) and (chunk, batch, observable)
+        output : str (default None)
+            in streaming mode the populations and observables are written to this path, preallocated either as a
+            directory of memory-mapped .npy files or, for paths ending in .h5 or .hdf5, as HDF5 datasets
+        ntraj : integer (default 500)
+            number of trajectories for each initial state with the 'trajectories' method
+        workers : integer (default None)
+            number of worker processes of the 'trajectories' method, defaults to the number of cpus
+        seed : integer (default None)
+            seed of the 'trajectories' method, each trajectory gets its own seed so that the results are reproducible
+            for any number of workers
+        stats : WalkerStats (default None)
+            statistics of this run, defaults to the statistics of the walker if enabled. The wall time of the run is
+            recorded in the 'solve' phase (of which 'propagate' is spent in the engine) together with the counters
+            of the solver, and the hooks of the statistics are called at the end of the run.
+        start_time : float (default 0.)
+            time of the initial state is start_time + dt, the time samples are start_time + dt * (1, ..., time_samples)
+        checkpoint : str (default None)
+            path of the compressed .npz checkpoint, overwritten after every checkpoint_interval time samples
+        checkpoint_interval : integer (default 1000)
+            number of time samples between two checkpoints
+        max_bytes : integer (default None)
+            maximum size of the states propagated together by the 'krylov' engine, by default 16 times the size of
+            the Liouvillian and at least 64 MB
+
+        Returns
+        -------
+        (qutip.Result) or list of qutip.Result
+            return the final quantum state at the end of the quantum simulation, one result per initial state
+            if a list of initial states is given. In streaming mode the states are not stored, the expectation values
+            are memory-mapped views of a .npy output, are read in memory from an HDF5 output and the path of the
+            output is stored in result.output. With a checkpoint and without an output the expectation values are
+            kept in memory, while with only a callback they are not stored (result.expect is empty).
+            The 'trajectories' method stores the mean populations (time, dim) in result.populations and the standard
+            errors in result.populations_stderr and result.expect_stderr.
+        """
+        opts = _options(opts, store_states=False, store_final_state=True)
+        times = start_time + np.arange(1, time_samples + 1) * dt  # timesteps of the evolution
+        if checkpoint is not None:
+            metadata = {'start_time': float(start_time), 'dt': float(dt), 'time_samples': int(time_samples),
+                        'batch': isinstance(initial_quantum_state, (list, tuple, np.ndarray)),
+                        'interval': int(checkpoint_interval)}
+            checkpoint = (checkpoint, metadata)
+        return self._run_with_stats(stats, initial_quantum_state=initial_quantum_state, times=times,
+                                    observables=observables, opts=opts, method=method, chunk_size=chunk_size,
+                                    callback=callback, output=output, ntraj=ntraj, workers=workers, seed=seed,
+                                    checkpoint=checkpoint, max_bytes=max_bytes)
+
+    def resume_walker(self, checkpoint, observables=[], opts=None, callback=None, output=None, stats=None):
+        """ Continues a run of run_walker from its last checkpoint, with the same time grid and method of the
+        interrupted run, and keeps updating the checkpoint.
+
+        The walker must have the same graph and parameters of the checkpointed run. The expectation values of the
+        results cover the whole time grid, the ones before the checkpoint being read from it, while the callback
+        is only called for the chunks after the checkpoint and an output is reopened and completed.
+
+        Parameters
+        ----------
+        checkpoint : str
+            path of the checkpoint written by run_walker
+        observables : list (default empty)
+            the observables of the interrupted run
+        opts : qutip.Options (default None)
+            options for the 'ode' engine
+        callback : function (default None)
+            called for each chunk as in run_walker
+        output : str (default None)
+            output of the interrupted run
+        stats : WalkerStats (default None)
+            statistics of this run, as in run_walker
+
+        Returns
+        -------
+        (qutip.Result) or list of qutip.Result
+            results as in run_walker
+        """
+        from qutip import Qobj
+
+        state, expect, metadata = load_checkpoint(checkpoint)
+        if metadata['walker'] != self._checkpoint_key():
+            raise ValueError('The checkpoint was written by a walker with a different graph or parameters')
+        assert expect.shape[2] == len(observables), 'The observables must be the same of the interrupted run'
+        times = metadata['start_time'] + np.arange(1, metadata['time_samples'] + 1) * metadata['dt']
+        step = metadata['step']
+        opts = _options(opts, store_states=False, store_final_state=True)
+        # the run restarts from the saved state of the engine, the initial states only set the shape of the results
+        initial_states = [Qobj(sp.csr_matrix((self.dim, self.dim))) for _ in range(expect.shape[1])]
+        return self._run_with_stats(stats, initial_quantum_state=initial_states, times=times, observables=observables,
+                                    opts=opts, method=metadata['method'], chunk_size=metadata['interval'],
+                                    callback=callback, output=output, checkpoint=(checkpoint, metadata),
+                                    resume=(step, expect[:step], metadata['batch'], state))
+
+    def _checkpoint_key(self):
+        """ Hash of the graph and of the parameters of the walker, stored in the checkpoints. """
+        return graph_hash(self._adjacency, [int(k) for k in self.sink_nodes], [float(r) for r in self._sink_jumps[2]],
+                          float(self.p), np.dtype(self.dtype).name, bool(self.packed))
+
+    def _run_with_stats(self, stats, **kwargs):
+        """ _run_walker, with the keyword arguments kwargs, collecting the statistics in stats (defaults to the
+        statistics of the walker), whose hooks are called at the end of the run. """
+        stats = self.stats if stats is None else stats
+        previous, self.stats = self.stats, stats
+        try:
+            results = self._run_walker(**kwargs)
+        finally:
+            self.stats = previous
+        if stats is not None:
+            stats.report()
+        return results
+
+    def _run_walker(self, initial_quantum_state, times, observables, opts, method, chunk_size, callback=None,
+                    output=None, ntraj=None, workers=None, seed=None, checkpoint=None, resume=None, max_bytes=None):
+        """ Implementation of run_walker and resume_walker. checkpoint is the (path, metadata) of the checkpoints of
+        the run and resume the (step, expect, batch, state) of the checkpoint the run restarts from, where state is
+        the saved state of the engine, max_bytes limits the blocks of the 'krylov' engine. """
+        if method == 'trajectories':
+            if checkpoint is not None:
+                raise ValueError("The 'trajectories' method does not support checkpoints")
+            return self._run_trajectories(initial_quantum_state, times, observables, ntraj, workers, seed)
+        step, expect, batch, state = (0, None, None, None) if resume is None else resume
+        is_batch, initial_states, method, engine, states = self._prepare_run(initial_quantum_state, times[step:], opts,
+                                                                             method, state, max_bytes)
+        with phase(self.stats, 'solve'):
+            results = self._solve(engine, states, times, observables, initial_states, opts, method, chunk_size,
+                                  callback, output, checkpoint, step, expect)
+        if self.stats is not None:
+            self.stats.record_run(method=method, batch=len(initial_states), time_samples=len(times) - step,
+                                  **getattr(engine, 'statistics', {}))
+        return results if (is_batch if batch is None else batch) else results[0]
+
+    def _solve(self, engine, states, times, observables, initial_states, opts, method, chunk_size, callback, output,
+               checkpoint=None, step=0, expect=None):
+        """ Results of the states yielded by an engine from times[step], in streaming mode if a callback, an output or
+        a checkpoint is given. expect are the expectation values before times[step] of a resumed run. """
+        from qutip import Qobj
+        from qutip.solver import Result
+
+        if callback is None and output is None and checkpoint is None:
+            return _collect(engine, states, times, observables, initial_states, opts, method)
+
+        complex_expect = any(not (isinstance(op, Qobj) and op.isherm) for op in observables)
+        writer = None
+        if output is not None:
+            writer = open_output(output, len(times), len(initial_states), self.dim, len(observables),
+                                 complex if complex_expect else float, resume=step > 0)
+        if checkpoint is not None:
+            path, metadata = checkpoint
+            chunk_size = metadata['interval']
+            # expectation values since the beginning of the run, saved in every checkpoint
+            history = np.zeros((0, len(initial_states), len(observables)), dtype=complex if complex_expect else float)
+            history = history if expect is None else np.concatenate([history, expect])
+        start, last = step, None
+        for chunk_times, populations, chunk_expect, last in _stream(engine, states, times[step:], observables,
+                                                                    initial_states, chunk_size):
+            if writer is not None:
+                writer.write(start, chunk_times, populations, chunk_expect)
+            if callback is not None:
+                callback(chunk_times, populations, chunk_expect)
+            start += len(chunk_times)
+            if checkpoint is not None:
+                history = np.concatenate([history, chunk_expect])
+                metadata.update(walker=self._checkpoint_key(), step=start - 1, method=method,
+                                statistics=getattr(engine, 'statistics', {}))
+                write_checkpoint(path, engine.save_state(last), history, metadata)
+        stored = None
+        if isinstance(writer, NpyOutput):
+            stored = writer.expect
+        elif writer is not None:
+            # read before closing the HDF5 file, the expectation values are small next to the populations
+            stored = writer.expect[()]
+        elif checkpoint is not None:
+            stored = history
+        if writer is not None:
+            writer.close()
+
+        results = []
+        for b, state in enumerate(initial_states):
+            result = Result()
+            result.solver = method
+            result.times = times
+            result.num_expect = len(observables)
+            result.output = output
+            if stored is not None:
+                result.expect = [stored[:, b, m] for m in range(len(observables))]
+            if opts.store_final_state and last is not None:
+                result.final_state = Qobj(engine.density(last, b), dims=state.dims, isherm=state.isherm or None)
+            results.append(result)
+        return results
+
+    def _run_trajectories(self, initial_quantum_state, times, observables, ntraj, workers, seed):
+        """ Implementation of the 'trajectories' method of run_walker. """
+        from qutip import Qobj
+        from qutip.solver import Result
+
+        # the expectation values of the trajectories are real, the ones of non hermitian observables would lose their
+        # imaginary part
+        if any(not isinstance(op, Qobj) or not op.isherm for op in observables):
+            raise ValueError("The 'trajectories' method only supports hermitian Qobj observables")
+        batch = isinstance(initial_quantum_state, (list, tuple, np.ndarray))
+        initial_states = [self._initial_state(state)
+                          for state in (initial_quantum_state if batch else [initial_quantum_state])]
+        (rows, cols, rates), (sink_rows, sink_cols, sink_rates) = self._graph_jumps, self._sink_jumps
+        jump_rates = sp.csr_matrix((np.concatenate([self.p * rates, sink_rates]),
+                                    (np.concatenate([rows, sink_rows]), np.concatenate([cols, sink_cols]))),
+                                   shape=(self.dim, self.dim))
+        _, escape = self.rate_matrix()
+        with phase(self.stats, 'solve'):
+            averages = run_trajectories(self._hamiltonian, jump_rates, escape,
+                                        [_pure_ensemble(state.data) for state in initial_states], times,
+                                        [sp.csr_matrix(op.data) for op in observables], ntraj, workers, seed)
+        if self.stats is not None:
+            self.stats.record_run(method='trajectories', batch=len(initial_states), time_samples=len(times),
+                                  ntraj=ntraj)
+        results = []
+        for populations, expect, populations_stderr, expect_stderr in averages:
+            result = Result()
+            result.solver = 'trajectories'
+            result.times = times
+            result.ntraj = ntraj
+            result.num_expect = len(observables)
+            result.expect = list(expect.T)
+            result.expect_stderr = list(expect_stderr.T)
+            result.populations = populations
+            result.populations_stderr = populations_stderr
+            results.append(result)
+        return results if batch else results[0]
+
+    def stream_walker(self, initial_quantum_state, time_samples, dt=1e-2, observables=[], chunk_size=1000, opts=None,
+                      method=None, start_time=0.):
+        """ Generator running the walker in chunks of time samples, only one chunk is kept in memory.
+
+        Parameters are the same of run_walker.
+
+        Yields
+        ------
+        (np.array, np.array, np.array)
+            times (chunk,), populations (chunk, batch, dim) and expectation values (chunk, batch, observable),
+            where batch is the number of initial states (1 for a single initial state)
+        """
+        times = start_time + np.arange(1, time_samples + 1) * dt  # timesteps of the evolution
+        _, initial_states, _, engine, states = self._prepare_run(initial_quantum_state, times, opts, method)
+        for chunk_times, populations, expect, _ in _stream(engine, states, times, observables, initial_states,
+                                                           chunk_size):
+            yield chunk_times, populations, expect
+
+    def run_until(self, initial_quantum_state, sink_threshold=None, max_time=100., dt=1e-1, predicates=None, opts=None,
+                  method=None):
+        """ First passage mode: runs the walker until the population of the sinks reaches sink_threshold (or one of
+        the predicates is met) and returns the hitting time, stopping the integration as soon as the condition holds
+        for every initial state.
+
+        The sink population and its exact time derivative, sum_k rate_k * rho[sink_node_k, sink_node_k], are
+        monitored every dt and the crossing of the threshold is located by cubic Hermite interpolation within the
+        step, so dt can be much larger than the required accuracy on the hitting time. Predicates are only checked
+        on the samples.
+
+        Parameters
+        ----------
+        initial_quantum_state : qutip.qobj.Qobj or integer specifying the initial node, or a list of them
+            quantum state of the system at the beginning of the simulation. A list of initial states is
+            propagated together as a single batched evolution, each with its own hitting time.
+        sink_threshold : float (default None)
+            total population of the sinks to reach, None to only check the predicates
+        max_time : float (default 100.)
+            time after which the run stops even if the condition was not met
+        dt : float (default 10**-1)
+            interval between the checks of the condition
+        predicates : list of functions (default None)
+            called as predicate(t, populations) with the populations (batch, dim) at time t, returning a bool or an
+            array of bools (batch,) which stops the walker of the corresponding initial states
+        opts : qutip.Options (default None)
+            options for the 'ode' engine
+        method : string (default None)
+            propagation engine, one of 'ode', 'krylov', 'propagator', 'classical' or 'unitary' (see run_walker)
+
+        Returns
+        -------
+        float or np.array
+            hitting time, measured from the initial state, for the initial state or for each of the initial states.
+            NaN if the condition is not met within max_time.
+        """
+        assert sink_threshold is not None or predicates, 'Either a sink threshold or predicates are required'
+        if sink_threshold is not None:
+            assert self.sink_nodes, 'The walker has no sink'
+        predicates = predicates or []
+        steps = max(1, int(np.ceil(max_time / dt)))
+        times = np.linspace(0., max_time, steps + 1)
+        batch = isinstance(initial_quantum_state, (list, tuple, np.ndarray))
+        initial_states = [self._initial_state(state)
+                          for state in (initial_quantum_state if batch else [initial_quantum_state])]
+        method = _select_method(method, self.p, self.hermitian and not self.sink_nodes,
+                                all(is_pure(state.data) for state in initial_states))
+        engine = self._engine(method, times, opts)
+        states = engine.propagate(engine.prepare([state.data for state in initial_states]), times)
+        if self.stats is not None:
+            states = self.stats.timed(states, 'propagate')
+
+        _, sink_sources, sink_rates = self._sink_jumps
+        hitting = np.full(len(initial_states), np.nan)
+        previous = None
+        with phase(self.stats, 'solve'):
+            for t_idx, (t, states_t) in enumerate(zip(times, states)):
+                populations = engine.populations(states_t)
+                running = np.isnan(hitting)
+                if sink_threshold is not None:
+                    sink = populations[self.N:].sum(axis=0)
+                    rate = sink_rates @ populations[sink_sources]
+                    crossed = running & (sink >= sink_threshold)
+                    for b in np.flatnonzero(crossed):
+                        hitting[b] = t if previous is None else _hermite_crossing(
+                            times[t_idx - 1], t, previous[0][b], sink[b], previous[1][b], rate[b], sink_threshold)
+                    previous = sink, rate
+                for predicate in predicates:
+                    met = np.broadcast_to(np.asarray(predicate(t, populations.T), dtype=bool), hitting.shape)
+                    hitting[running & met & np.isnan(hitting)] = t
+                if not np.isnan(hitting).any():
+                    break
+            states.close()
+        if self.stats is not None:
+            self.stats.record_run(method=method, batch=len(initial_states), time_samples=t_idx + 1,
+                                  **getattr(engine, 'statistics', {}))
+        return hitting if batch else hitting[0]
+
+    def sweep(self, noise_params, initial_state, times, observables=None, workers=None, opts=None, method=None):
+        """ Run the walker for many values of the noise parameter on the same graph.
+
+        The Liouvillian components are built once and recombined as (1 - p) * coherent + p * classical + sink
+        for every point of the sweep, the points are distributed on a pool of processes.
+
+        Parameters
+        ----------
+        noise_params : array_like of floats between 0 and 1
+            values of the noise parameter to simulate
+        initial_state : qutip.qobj.Qobj or integer specifying the initial node
+            quantum state of the system at the beginning of the simulation
+        times : array_like
+            times at which the observables are evaluated, the initial state is taken at times[0]
+        observables : list (default None)
+            list of observables to track during the dynamics, defaults to the population of each node (and sinks)
+        workers : integer (default None)
+            number of worker processes, defaults to the number of cpus. With 1 worker the sweep runs in process.
+        opts : qutip.Options
             options for QuTip's solver mesolve.
+        method : string (default None)
+            propagation engine (see run_walker), by default the reduced engines are used for p = 0 and p = 1.
 
         Returns
         -------
-        (qutip.Result)
-            return the final quantum state at the end of the quantum simulation.
+        np.array
+            expectation values with shape (len(noise_params), len(times), len(observables)).
         """
-        times = np.arange(1, time_samples + 1) * dt  # timesteps of the evolution
+        from qutip import Qobj
 
-        # if the initial quantum state is specified as a node create the corresponding density matrix
-        if type(initial_quantum_state) == int:
-            density_matrix_value = np.zeros((self.N,self.N))
-            density_matrix_value[initial_quantum_state, initial_quantum_state] = 1
-            initial_quantum_state = Qobj(density_matrix_value)
+        opts = _options(opts, store_states=False, store_final_state=False)
+        initial_state = self._initial_state(initial_state)
+        if observables is None:
+            observables = [Qobj(sp.csr_matrix(([1.], ([k], [k])), shape=(self.dim, self.dim)))
+                           for k in range(self.dim)]
+        closed = self.hermitian and not self.sink_nodes and is_pure(initial_state.data)
+        for noise_param in noise_params:
+            # an engine outside of its limit fails before starting the pool
+            _select_method(method, noise_param, closed, True)
+        eigensystem = self.eigensystem() if closed and 0 in np.asarray(noise_params) else None
+        initargs = (self.liouvillian_components(), (self._graph_jumps, self._sink_jumps), eigensystem, initial_state,
+                    np.asarray(times), observables, opts, method)
+        if workers == 1:
+            _init_sweep(*initargs)
+            return np.array([_sweep_point(p) for p in noise_params])
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep, initargs=initargs) as pool:
+            return np.array(list(pool.map(_sweep_point, noise_params)))
+
+    def _absorption_vectors(self, solver='direct'):
+        """ Adjoint solutions w = L_s^-T c and z = L_s^-T w, where L_s is the Liouvillian restricted to the nodes
+        of the graph and c the vector of the rates into the sinks. They are cached on the walker.
+
+        Since the coherences with the sinks are never populated, the sinks are fed only by the populations of
+        the system block and for any initial state of the system rho_0 the transferred population is
+        -w^T rho_0 while the first moment of the arrival time distribution is z^T rho_0.
+        """
+        assert self.sink_nodes, 'The walker has no sink'
+        if self._absorption is None:
+            self._absorption = self._solve_absorption(solver)
+        return self._absorption
+
+    def _solve_absorption(self, solver):
+        n = self.dim
+        system = (np.arange(self.N)[:, None] + n * np.arange(self.N)[None, :]).ravel(order='F')
+        # always in double precision, the efficiencies are differences of populations
+        adjoint = self.liouvillian()[system][:, system].T.tocsc().astype(complex)
+        rows, cols, rates = self._sink_jumps
+        c = np.zeros(self.N ** 2)
+        np.add.at(c, cols * (self.N + 1), rates)
+        with phase(self.stats, 'absorption'):
+            if solver == 'direct':
+                lu = _factorize(adjoint)
+                w = lu.solve(c.astype(complex))
+                z = lu.solve(w)
+            elif solver == 'iterative':
+                # after update_edges the previous solutions and preconditioner are reused, since changing a few edges
+                # is a low rank perturbation of the Liouvillian
+                w0, z0 = self._absorption_guess if self._absorption_guess is not None else (None, None)
+                if self._preconditioner is None:
+                    try:
+                        ilu = spla.spilu(adjoint, drop_tol=1e-5, fill_factor=20)
+                    except RuntimeError:
+                        ilu = None
+                    # the incomplete factorization can break down, or look singular, where the exact one does not,
+                    # which then checks whether the Liouvillian is singular
+                    if ilu is None or _condition(adjoint, ilu) > _MAX_CONDITION:
+                        ilu = _factorize(adjoint)
+                    self._preconditioner = spla.LinearOperator(adjoint.shape, ilu.solve, dtype=complex)
+                w, info = spla.gmres(adjoint, c.astype(complex), x0=w0, M=self._preconditioner, rtol=1e-10,
+                                     atol=1e-12, restart=30, maxiter=4)
+                z, info_z = spla.gmres(adjoint, w, x0=z0, M=self._preconditioner, rtol=1e-10, atol=1e-12,
+                                       restart=30, maxiter=4) if info == 0 else (None, info)
+                if info != 0 or info_z != 0:
+                    # preconditioner too coarse or of a graph too different: solve exactly and keep the factorization
+                    # as the preconditioner of the next updates
+                    lu = _factorize(adjoint)
+                    self._preconditioner = spla.LinearOperator(adjoint.shape, lu.solve, dtype=complex)
+                    w = lu.solve(c.astype(complex))
+                    z = lu.solve(w)
+            else:
+                raise ValueError("Unknown solver '%s', use 'direct' or 'iterative'" % solver)
+        return w, z
+
+    def _system_states(self, initial_states):
+        """ Vectorized system blocks (N**2, batch) and sink populations (batch,) of a batch of initial states, given
+        as in run_walker. """
+        vectors, sink_population = [], []
+        for state in initial_states:
+            if isinstance(state, (int, np.integer)):
+                rho = sp.csr_matrix(([1.], ([state], [state])), shape=(self.N, self.N))
+                sink_population.append(0.)
+            else:
+                # kets and density matrices of the system only are converted to density matrices with the sinks
+                rho = self._initial_state(state).data
+                sink_population.append(np.real(rho[self.N:, self.N:].diagonal()).sum())
+                rho = rho[:self.N, :self.N]
+            vectors.append(rho.toarray().ravel(order='F'))
+        return np.array(vectors).T, np.array(sink_population)
+
+    def transfer_efficiency(self, initial_state, solver='direct'):
+        """ Asymptotic population of the sinks, computed with a single adjoint linear solve against the Liouvillian
+        instead of a time evolution. The solve is cached, so batches of initial states come at no extra cost.
+
+        The graph must be connected to the sinks and have no dark states, otherwise the restricted Liouvillian is
+        singular and a ValueError is raised, e.g. for the fully quantum walker on a complete graph:
+
+        >>> import numpy as np
+        >>> walker = SQWalker(np.ones((4, 4)) - np.eye(4), noise_param=0., sink_node=3)
+        >>> walker.transfer_efficiency(0)  # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        ValueError: The Liouvillian restricted to the graph is singular: ...
+
+        Parameters
+        ----------
+        initial_state : qutip.qobj.Qobj or integer specifying the initial node, or a list of them
+            quantum state of the system at the beginning of the simulation
+        solver : string (default 'direct')
+            'direct' for a sparse LU factorization, 'iterative' for GMRES with an incomplete LU preconditioner
 
-        # if a sink is present add it to the density matrix of the system
-        if self.sink_node is not None and initial_quantum_state.shape == (self.N, self.N):
-            initial_quantum_state = Qobj(np.pad(initial_quantum_state.data.toarray(), [(0, 1), (0, 1)], 'constant'))
+        Returns
+        -------
+        float or np.array
+            transfer efficiency for the initial state or for each of the initial states
+        """
+        batch = isinstance(initial_state, (list, tuple, np.ndarray))
+        vectors, sink_population = self._system_states(initial_state if batch else [initial_state])
+        w, _ = self._absorption_vectors(solver)
+        efficiency = sink_population - np.real(w @ vectors)
+        return efficiency if batch else efficiency[0]
+
+    def mean_arrival_time(self, initial_state, solver='direct'):
+        """ Mean arrival time in the sinks of the transferred population, computed together with the transfer
+        efficiency from two cached adjoint linear solves (see transfer_efficiency).
+
+        Parameters
+        ----------
+        initial_state : qutip.qobj.Qobj or integer specifying the initial node, or a list of them
+            quantum state of the system at the beginning of the simulation
+        solver : string (default 'direct')
+            'direct' for a sparse LU factorization, 'iterative' for GMRES with an incomplete LU preconditioner
+
+        Returns
+        -------
+        float or np.array
+            mean arrival time for the initial state or for each of the initial states
+        """
+        batch = isinstance(initial_state, (list, tuple, np.ndarray))
+        vectors, _ = self._system_states(initial_state if batch else [initial_state])
+        w, z = self._absorption_vectors(solver)
+        arrival_time = np.real(z @ vectors) / -np.real(w @ vectors)
+        return arrival_time if batch else arrival_time[0]
+
+    def efficiency_gradient(self, initial_state, time=None, edges=None, sinks=None, time_samples=256):
+        """ Transfer efficiency, either at steady state or as the population of the sinks at a given time, together
+        with its gradient with respect to the edge weights, the noise parameter and the sink rates, computed with
+        the adjoint method at the cost of about two simulations for any number of parameters.
+
+        At steady state the efficiency into the selected sinks is c^T X, with X = -L_s^-1 rho_0 the time integral of
+        the system block of the state and c the rates into those sinks, and every derivative is d c^T X - w^T dL_s X
+        where w = L_s^-T c, both solutions sharing the LU factorization of L_s. Since all the population eventually
+        reaches the sinks, the steady state efficiency into all of them is 1 and only the efficiency into a subset of
+        the sinks has a non trivial gradient. As in transfer_efficiency, a ValueError is raised if L_s is singular,
+        even only numerically (e.g. with dark states). At a finite time T the derivatives are the integrals
+        over s in [0, T] of mu(s)^T dL rho(s), where the state rho is propagated forward and the adjoint
+        mu(s) = exp(L^T (T - s)) m of the readout m of the sink populations backward with Krylov, and the integrals
+        are computed with Simpson's rule on time_samples intervals. The forward states are kept in memory.
+
+        Since every superoperator is linear in the Hamiltonian and in the jump rates, the derivatives with
+        respect to all the entries follow from the same pair of solutions, and the derivatives with respect to
+        the edge weights include the normalization of the jump rates by the degrees.
+
+        Parameters
+        ----------
+        initial_state : qutip.qobj.Qobj or integer specifying the initial node
+            quantum state of the system at the beginning of the simulation
+        time : float (default None)
+            time at which the population of the sinks is computed, None for the steady state
+        edges : list of (i, j) (default None)
+            entries of the adjacency matrix to differentiate, including absent edges, by default the edges of the
+            graph. For an undirected link the derivative of a symmetric change is gradient[i, j] + gradient[j, i].
+        sinks : list of integers (default None)
+            positions in self.sink_nodes of the sinks whose population is the efficiency, by default all of them
+        time_samples : integer (default 256)
+            number of intervals of the quadrature at a finite time, rounded up to an even number
+
+        Returns
+        -------
+        (float, dict)
+            efficiency and its derivatives: 'edges' as a sparse (N, N) matrix with the derivative with respect to
+            each entry adjacency[i, j] of edges, 'noise_param' as a float and 'sink_rate' as an array with the
+            derivative with respect to the rate of each sink
+        """
+        assert self.sink_nodes, 'The walker has no sink'
+        n, n_sinks = self.dim, len(self.sink_nodes)
+        adjacency = self._adjacency.tocoo()
+        if edges is None:
+            edge_rows, edge_cols = adjacency.row, adjacency.col
+        else:
+            edge_rows, edge_cols = (np.asarray(column, dtype=int) for column in zip(*edges))
+        jump_rows, jump_cols, jump_rates = self._graph_jumps
+        sink_rows, sink_cols, sink_rates = self._sink_jumps
+        selected = np.zeros(n_sinks, dtype=bool)
+        selected[np.arange(n_sinks) if sinks is None else np.asarray(sinks, dtype=int)] = True
+        # Hamiltonian entries of the graph and of the edges, jumps of the graph, of the edges (|j><i| for the entry
+        # adjacency[i, j]) and of the sinks
+        h_rows, h_cols = np.concatenate([adjacency.row, edge_rows]), np.concatenate([adjacency.col, edge_cols])
+        j_rows = np.concatenate([jump_rows, edge_cols, sink_rows])
+        j_cols = np.concatenate([jump_cols, edge_rows, sink_cols])
+        coherent, jumps = np.zeros(len(h_rows), dtype=complex), np.zeros(len(j_rows), dtype=complex)
+        readout = np.zeros(n_sinks)
+
+        if time is None:
+            rho = self._initial_state(initial_state).data
+            vectors, _ = self._system_states([initial_state])
+            system = (np.arange(self.N)[:, None] + n * np.arange(self.N)[None, :]).ravel(order='F')
+            c = np.zeros(self.N ** 2, dtype=complex)
+            np.add.at(c, sink_cols[selected] * (self.N + 1), sink_rates[selected])
+            with phase(self.stats, 'absorption'):
+                lu = _factorize(self.liouvillian()[system][:, system].tocsc().astype(complex))
+                w = lu.solve(c, trans='T')
+                integral = lu.solve(-vectors[:, 0].astype(complex))
+            efficiency = np.real(rho.diagonal()[self.N:][selected].sum() + c @ integral)
+            # the system blocks padded with the sinks, whose levels are outside of the adjoint problem
+            adjoint, state = np.zeros((n, n), dtype=complex), np.zeros((n, n), dtype=complex)
+            adjoint[:self.N, :self.N] = -w.reshape((self.N, self.N), order='F')
+            state[:self.N, :self.N] = integral.reshape((self.N, self.N), order='F')
+            coherent, jumps = _sensitivities(adjoint, state, h_rows, h_cols, j_rows, j_cols)
+            # the rates also appear in the readout c of the flux into the sinks
+            readout = np.real(np.diagonal(state)[sink_cols]) * selected
+        else:
+            steps = time_samples + time_samples % 2
+            times = np.linspace(0., time, steps + 1)
+            liouvillian = self.liouvillian()
+            rho = self._initial_state(initial_state).data
+            sinks = np.zeros((n * n, 1))
+            sinks[(self.N + np.flatnonzero(selected)) * (n + 1)] = 1.
+            with phase(self.stats, 'solve'):
+                forward = KrylovEngine(liouvillian)
+                states = list(forward.propagate(forward.prepare([rho]), times))
+                efficiency = np.real(sinks[:, 0] @ states[-1][:, 0])
+                backward = KrylovEngine(liouvillian.T.tocsr())
+                weights = _simpson_weights(steps, times[1] - times[0])
+                for k, mu in enumerate(backward.propagate(sinks.astype(complex), times)):
+                    # mu(T - times[k]) pairs with the state at the same time
+                    adjoint = mu[:, 0].reshape((n, n), order='F')
+                    state = states[steps - k][:, 0].reshape((n, n), order='F')
+                    d_coherent, d_jumps = _sensitivities(adjoint, state, h_rows, h_cols, j_rows, j_cols)
+                    coherent += weights[steps - k] * d_coherent
+                    jumps += weights[steps - k] * d_jumps
+                    states[steps - k] = None
 
-        return mesolve(self.quantum_hamiltonian, initial_quantum_state, times,
-                       self.classical_hamiltonian, observables, options=opts)
+        n_graph, n_edges = len(jump_rows), len(edge_rows)
+        graph_coherent, edge_coherent = coherent[:len(adjacency.row)], coherent[len(adjacency.row):]
+        graph_jumps, edge_jumps, sink_jumps = np.split(jumps, [n_graph, n_graph + n_edges])
+        # the rate of |j><i| is p * adjacency[i, j] / degree[j], so an entry of column j changes all the jumps to j
+        inverse_degree = np.divide(1., self.degree, out=np.zeros(self.N), where=self.degree > 0)
+        normalization = np.bincount(jump_rows, weights=np.real(graph_jumps) * jump_rates, minlength=self.N)
+        d_edges = ((1 - self.p) * np.real(edge_coherent) +
+                   self.p * (np.real(edge_jumps) - normalization[edge_cols]) * inverse_degree[edge_cols])
+        d_noise = np.real(jump_rates @ graph_jumps - adjacency.data @ graph_coherent)
+        # sink rates enter the jumps as 2 * sink_rate
+        d_sink = 2 * (np.real(sink_jumps) + readout)
+        gradient = {'edges': sp.csr_matrix((d_edges, (edge_rows, edge_cols)), shape=(self.N, self.N)),
+                    'noise_param': d_noise, 'sink_rate': d_sink}
+        return efficiency, gradient
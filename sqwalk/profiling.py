@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the walker: wall time of the construction and solve phases, sizes of the operators, counters of
+the solvers and peak memory, collected in a WalkerStats object.
+"""
+
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+class WalkerStats(object):
+    """
+    Statistics collected by a walker. The wall times of repeated phases are accumulated.
+
+    Phases recorded by SQWalker: 'laplacian', 'hamiltonian', 'jumps', 'jump_operators' (QuTip collapse operators),
+    'liouvillian', 'eigensystem', 'propagator', 'absorption' (adjoint solves of transfer_efficiency) and for each run
+    'solve', of which 'propagate' is the time spent inside the engine.
+
+    Parameters
+    ----------
+    hooks : list of functions (default None)
+        called as hook(stats) with the dictionary of the statistics (see as_dict) at the end of every run, e.g. to
+        forward them to an external metrics system
+    trace_memory : bool (default False)
+        trace the peak of the memory allocated during each phase with tracemalloc, which slows down the allocations.
+        Otherwise only the peak resident memory of the process is recorded.
+    """
+    def __init__(self, hooks=None, trace_memory=False):
+        self.hooks = list(hooks) if hooks else []
+        self.trace_memory = trace_memory
+        self.phases = {}
+        self.counters = {}
+        self.run = {}
+        self.peak_memory = {}
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    @contextmanager
+    def phase(self, name):
+        """ Context manager adding the wall time (and the traced peak memory) of its block to the phase name. """
+        # nested phases share the tracing of the outermost one, so their peak includes the enclosing block
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.phases[name] = self.phases.get(name, 0.) + time.perf_counter() - start
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                self.peak_memory[name] = max(self.peak_memory.get(name, 0), peak)
+                if tracing:
+                    tracemalloc.stop()
+
+    def timed(self, iterator, name):
+        """ Iterates over iterator adding the time spent producing its items to the phase name. """
+        iterator = iter(iterator)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.phases[name] = self.phases.get(name, 0.) + time.perf_counter() - start
+            yield item
+
+    def update(self, **counters):
+        """ Sets counters such as the sizes of the operators. """
+        self.counters.update(counters)
+
+    def record_run(self, **counters):
+        """ Replaces the counters of the last run, such as the engine and the steps of the solver. """
+        self.run = dict(counters)
+
+    def as_dict(self):
+        """ Statistics as a dictionary with the keys 'phases' (seconds), 'counters', 'run' (counters of the last
+        run) and 'peak_memory' (bytes). The peak resident memory of the process is stored in
+        peak_memory['process']. """
+        peak_memory = dict(self.peak_memory)
+        if resource is not None:
+            # kilobytes on Linux, bytes on macOS
+            scale = 1 if sys.platform == 'darwin' else 1024
+            peak_memory['process'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        return {'phases': dict(self.phases), 'counters': dict(self.counters), 'run': dict(self.run),
+                'peak_memory': peak_memory}
+
+    def report(self):
+        """ Calls the hooks with the current statistics. """
+        stats = self.as_dict()
+        for hook in self.hooks:
+            hook(stats)
+        return stats
+
+    def reset(self):
+        self.phases.clear()
+        self.counters.clear()
+        self.run = {}
+        self.peak_memory.clear()
+
+
+@contextmanager
+def phase(stats, name):
+    """ stats.phase(name), or nothing if stats is None. """
+    if stats is None:
+        yield None
+    else:
+        with stats.phase(name):
+            yield stats
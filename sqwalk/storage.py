@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Preallocated on-disk outputs for the streaming mode of the walker, so that the size of long runs is limited by
+the disk instead of the memory, and checkpoints from which interrupted runs are resumed.
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+class NpyOutput(object):
+    """ Directory of memory-mapped .npy arrays: times (time,), populations (time, batch, dim) and
+    expect (time, batch, observable). With resume the existing arrays are opened for writing. """
+    def __init__(self, path, time_samples, batch, dim, n_observables, expect_dtype, resume=False):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        mode = 'r+' if resume else 'w+'
+        self.times = np.lib.format.open_memmap(os.path.join(path, 'times.npy'), mode=mode, dtype=float,
+                                               shape=(time_samples,))
+        self.populations = np.lib.format.open_memmap(os.path.join(path, 'populations.npy'), mode=mode, dtype=float,
+                                                     shape=(time_samples, batch, dim))
+        self.expect = np.lib.format.open_memmap(os.path.join(path, 'expect.npy'), mode=mode, dtype=expect_dtype,
+                                                shape=(time_samples, batch, n_observables))
+
+    def write(self, start, times, populations, expect):
+        stop = start + len(times)
+        self.times[start:stop] = times
+        self.populations[start:stop] = populations
+        self.expect[start:stop] = expect
+
+    def close(self):
+        for array in (self.times, self.populations, self.expect):
+            array.flush()
+
+
+class HDF5Output(object):
+    """ HDF5 file with the datasets times (time,), populations (time, batch, dim) and
+    expect (time, batch, observable), written chunk by chunk. With resume the existing datasets are opened for
+    writing. Requires h5py. """
+    def __init__(self, path, time_samples, batch, dim, n_observables, expect_dtype, resume=False):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError('h5py is required to stream the output to HDF5 files')
+        self.path = path
+        if resume:
+            self.file = h5py.File(path, 'r+')
+            self.times, self.populations, self.expect = (self.file[name] for name in ('times', 'populations', 'expect'))
+            return
+        self.file = h5py.File(path, 'w')
+        self.times = self.file.create_dataset('times', shape=(time_samples,), dtype=float)
+        self.populations = self.file.create_dataset('populations', shape=(time_samples, batch, dim), dtype=float,
+                                                    chunks=True)
+        self.expect = self.file.create_dataset('expect', shape=(time_samples, batch, n_observables),
+                                               dtype=expect_dtype, chunks=True if n_observables else None)
+
+    def write(self, start, times, populations, expect):
+        stop = start + len(times)
+        self.times[start:stop] = times
+        self.populations[start:stop] = populations
+        if expect.shape[-1]:
+            self.expect[start:stop] = expect
+
+    def close(self):
+        self.file.close()
+
+
+def open_output(path, time_samples, batch, dim, n_observables, expect_dtype, resume=False):
+    """ HDF5Output for paths ending in .h5 or .hdf5, NpyOutput (a directory of .npy files) otherwise. """
+    if path.endswith(('.h5', '.hdf5')):
+        return HDF5Output(path, time_samples, batch, dim, n_observables, expect_dtype, resume)
+    return NpyOutput(path, time_samples, batch, dim, n_observables, expect_dtype, resume)
+
+
+def write_checkpoint(path, state, expect, metadata):
+    """ Writes a compressed .npz checkpoint with the state of the engine at the last time sample, as the dict of
+    arrays of its save_state, the expectation values (time, batch, observable) computed so far and a dict of
+    metadata stored as JSON.
+
+    The checkpoint is written to a temporary file and then renamed, so that an interrupted write never corrupts
+    the previous checkpoint.
+    """
+    staging = path + '.tmp'
+    arrays = {'state_' + name: array for name, array in state.items()}
+    with open(staging, 'wb') as file:
+        np.savez_compressed(file, expect=expect, metadata=json.dumps(metadata), **arrays)
+    os.replace(staging, path)
+
+
+def load_checkpoint(path):
+    """ State of the engine (dict of arrays), expectation values and metadata of a checkpoint written by
+    write_checkpoint. """
+    with np.load(path, allow_pickle=False) as data:
+        state = {name[len('state_'):]: data[name] for name in data.files if name.startswith('state_')}
+        return state, data['expect'], json.loads(str(data['metadata']))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Quantum trajectories (Monte Carlo wavefunction) unraveling of the master equation of the walker.
+
+Every Lindblad operator of the walker is a single-entry jump |i><j|, so between jumps a trajectory evolves with the
+non-hermitian Hamiltonian H - i/2 diag(escape) and a jump simply relocates the walker on node i. Each trajectory
+only needs an N-dimensional state vector, which allows to simulate graphs far beyond the reach of density matrices.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+
+# operators shared by the trajectories of a process, set once per process by _init_trajectories
+_trajectory_context = {}
+
+
+def _init_trajectories(generator, rate_matrix, escape, frozen, ensembles, times, observables, seeds):
+    _trajectory_context.update(generator=generator, rate_matrix=rate_matrix, escape=escape, frozen=frozen,
+                               ensembles=ensembles, times=times, observables=observables, seeds=seeds,
+                               norm=abs(generator).sum(axis=0).max())
+
+
+def _propagate(psi, tau, tol=1e-13):
+    """ exp(tau G) psi with a Taylor series on sub-steps of tau, short enough that |G| tau / steps <= 1.
+
+    The norm of the generator is computed once, so that unlike expm_multiply there is no per call setup.
+    """
+    generator, norm = _trajectory_context['generator'], _trajectory_context['norm']
+    steps = max(1, int(np.ceil(norm * tau)))
+    h = tau / steps
+    for _ in range(steps):
+        term, result = psi, psi.copy()
+        for k in range(1, 40):
+            term = (h / k) * (generator @ term)
+            result += term
+            if np.abs(term).sum() <= tol * np.abs(result).sum():
+                break
+        psi = result
+    return psi
+
+
+def _find_jump(psi, interval, u, tol=1e-6, max_iter=20):
+    """ Time in (0, interval] and state at which the squared norm of psi decays to u, by regula falsi on the
+    logarithm of the norm, which is close to linear in time. """
+    lo, hi = 0., interval
+    log_lo, psi_lo = np.log(np.vdot(psi, psi).real), psi
+    psi_tau = _propagate(psi, interval)
+    log_hi = np.log(np.vdot(psi_tau, psi_tau).real)
+    tau = hi
+    for _ in range(max_iter):
+        tau = lo + (hi - lo) * (log_lo - np.log(u)) / (log_lo - log_hi)
+        psi_tau = _propagate(psi_lo, tau - lo)
+        log_tau = np.log(np.vdot(psi_tau, psi_tau).real)
+        if abs(log_tau - np.log(u)) < tol:
+            break
+        if log_tau > np.log(u):
+            lo, log_lo, psi_lo = tau, log_tau, psi_tau
+        else:
+            hi, log_hi = tau, log_tau
+    return tau, psi_tau
+
+
+def _jump(psi, rng):
+    """ Node reached by a jump from state psi: the source j is drawn with probability escape[j] |psi[j]|^2 and the
+    destination i with probability rate(j -> i) / escape[j]. """
+    rate_matrix, escape = _trajectory_context['rate_matrix'], _trajectory_context['escape']
+    weights = escape * np.abs(psi) ** 2
+    source = rng.choice(len(psi), p=weights / weights.sum())
+    start, stop = rate_matrix.indptr[source], rate_matrix.indptr[source + 1]
+    rates = rate_matrix.data[start:stop]
+    return rate_matrix.indices[start + rng.choice(stop - start, p=rates / rates.sum())]
+
+
+def _trajectory(state_index, seed, populations, expect, squares):
+    """ Runs one trajectory adding its populations, expectation values and their squares to the accumulators. """
+    context = _trajectory_context
+    frozen, times, observables = context['frozen'], context['times'], context['observables']
+    rng = np.random.default_rng(seed)
+    weights, kets = context['ensembles'][state_index]
+    psi = kets[:, rng.choice(len(weights), p=weights)].astype(complex)
+    u = rng.random()
+
+    frozen_state = False
+    for t_idx in range(len(times)):
+        if t_idx > 0 and not frozen_state:
+            remaining = times[t_idx] - times[t_idx - 1]
+            while True:
+                psi_next = _propagate(psi, remaining)
+                if np.vdot(psi_next, psi_next).real >= u:
+                    psi = psi_next
+                    break
+                tau, psi_jump = _find_jump(psi, remaining, u)
+                node = _jump(psi_jump, rng)
+                psi = np.zeros_like(psi)
+                psi[node] = 1.
+                frozen_state = frozen[node]
+                u = rng.random()
+                remaining -= tau
+                if frozen_state:
+                    break
+        norm = np.vdot(psi, psi).real
+        probabilities = np.abs(psi) ** 2 / norm
+        values = np.array([np.vdot(psi, op @ psi).real / norm for op in observables])
+        if frozen_state:
+            # the walker is absorbed in a level without dynamics, the rest of the trajectory is constant
+            populations[t_idx:] += probabilities
+            squares[0][t_idx:] += probabilities ** 2
+            expect[t_idx:] += values
+            squares[1][t_idx:] += values ** 2
+            return
+        populations[t_idx] += probabilities
+        squares[0][t_idx] += probabilities ** 2
+        expect[t_idx] += values
+        squares[1][t_idx] += values ** 2
+
+
+def _run_trajectories(task):
+    """ Sums over a block of trajectories of one initial state. """
+    state_index, trajectories = task
+    times, observables, seeds = (_trajectory_context['times'], _trajectory_context['observables'],
+                                 _trajectory_context['seeds'])
+    dim = _trajectory_context['escape'].shape[0]
+    populations = np.zeros((len(times), dim))
+    expect = np.zeros((len(times), len(observables)))
+    squares = (np.zeros_like(populations), np.zeros_like(expect))
+    for trajectory in trajectories:
+        _trajectory(state_index, seeds[state_index][trajectory], populations, expect, squares)
+    return state_index, populations, expect, squares
+
+
+def run_trajectories(hamiltonian, rate_matrix, escape, ensembles, times, observables, ntraj=500, workers=None,
+                     seed=None):
+    """ Averages of the populations and of the observables over quantum trajectories.
+
+    Parameters
+    ----------
+    hamiltonian : scipy.sparse matrix
+        hermitian part of the Hamiltonian of the walker
+    rate_matrix : scipy.sparse matrix
+        matrix of the jump rates, rate_matrix[i, j] is the rate of the jump |i><j|
+    escape : np.array
+        total rate of the jumps leaving each node
+    ensembles : list of (np.array, np.array)
+        for each initial state the weights and the kets (as columns) of a pure state decomposition
+    times : np.array
+        times at which the averages are computed, the initial states are taken at times[0]
+    observables : list of scipy.sparse matrices
+        hermitian observables to average
+    ntraj : integer (default 500)
+        number of trajectories for each initial state
+    workers : integer (default None)
+        number of worker processes, defaults to the number of cpus. With 1 worker the trajectories run in process.
+    seed : integer (default None)
+        seed of the trajectories, every trajectory has its own seed spawned from it so that the results do not
+        depend on the number of workers
+
+    Returns
+    -------
+    list of (np.array, np.array, np.array, np.array)
+        for each initial state the mean populations (time, dim), the mean expectation values (time, observable) and
+        their standard errors
+    """
+    generator = (-1j * (sp.csr_matrix(hamiltonian) - 0.5j * sp.diags(escape))).tocsr()
+    rate_matrix = sp.csc_matrix(rate_matrix)
+    # levels that the walker can never leave
+    frozen = (escape == 0) & (np.diff(sp.csr_matrix(hamiltonian).indptr) == 0)
+    seeds = [sequence.spawn(ntraj) for sequence in np.random.SeedSequence(seed).spawn(len(ensembles))]
+    initargs = (generator, rate_matrix, escape, frozen, ensembles, times, observables, seeds)
+
+    n_blocks = 1 if workers == 1 else 4 * (workers or os.cpu_count())
+    tasks = [(state_index, block) for state_index in range(len(ensembles))
+             for block in np.array_split(np.arange(ntraj), min(n_blocks, ntraj)) if len(block)]
+    if workers == 1:
+        _init_trajectories(*initargs)
+        partials = [_run_trajectories(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_trajectories, initargs=initargs) as pool:
+            partials = list(pool.map(_run_trajectories, tasks))
+
+    totals = [[0., 0., 0., 0.] for _ in ensembles]
+    for state_index, populations, expect, (population_squares, expect_squares) in partials:
+        for k, partial in enumerate((populations, expect, population_squares, expect_squares)):
+            totals[state_index][k] = totals[state_index][k] + partial
+    results = []
+    for populations, expect, population_squares, expect_squares in totals:
+        mean_populations, mean_expect = populations / ntraj, expect / ntraj
+        results.append((mean_populations, mean_expect,
+                        _standard_error(mean_populations, population_squares, ntraj),
+                        _standard_error(mean_expect, expect_squares, ntraj)))
+    return results
+
+
+def _standard_error(mean, squares, n):
+    if n < 2:
+        return np.full_like(mean, np.nan)
+    variance = np.maximum(squares / n - mean ** 2, 0.) * n / (n - 1)
+    return np.sqrt(variance / n)
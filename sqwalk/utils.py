@@ -1,87 +1,147 @@
-from qiskit import QuantumCircuit, transpile
-from qiskit.providers import BaseBackend
-from qiskit.result import Result
-from qiskit.providers.models import BackendProperties, BackendConfiguration
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-import time
-
-class FakeBackend(BaseBackend):
-    """This is a dummy backend just for transpile purposes."""
-    def __init__(self, n_qubits=3, topology=None, gates=None, time_alive=10):
-        """
-        Args:
-            configuration (BackendConfiguration): backend configuration
-            time_alive (int): time to wait before returning result
-        """
-        if topology is None:
-            cmap = [[i, j] for i in range(n_qubits) for j in range(n_qubits)]
-        else:
-            cmap = topology
-
-        if gates is None:
-            DEFAULT_BASIS_GATES = sorted(['p', 'rx', 'ry', 'rz', 'id', 'x',
-                                          'y', 'z', 'h', 's', 'sdg', 'sx', 't', 'tdg', 'swap', 'cx',
-                                          'cy', 'cz', 'csx', 'cp', 'rxx', 'ryy',
-                                          'rzz', 'rzx', 'ccx', 'cswap', 'mcx', 'mcy', 'mcz', 'mcsx',
-                                          'mcphase', 'mcrx', 'mcry', 'mcrz', 'mcr', 'mcswap'])
+from qiskit import QuantumCircuit, transpile
+from qiskit.circuit.library import get_standard_gate_name_mapping
+from qiskit.transpiler import CouplingMap, Target
+
+DEFAULT_BASIS_GATES = sorted(['p', 'rx', 'ry', 'rz', 'id', 'x',
+                              'y', 'z', 'h', 's', 'sdg', 'sx', 't', 'tdg', 'swap', 'cx',
+                              'cy', 'cz', 'csx', 'cp', 'rxx', 'ryy',
+                              'rzz', 'rzx', 'ccx', 'cswap', 'mcx', 'mcy', 'mcz', 'mcsx',
+                              'mcphase', 'mcrx', 'mcry', 'mcrz', 'mcr', 'mcswap'])
+
+# decomposed circuits by unitary hash, topology, gate set and optimization level, least recently used first
+_decompositions = OrderedDict()
+CACHE_SIZE = 1024
+
+# transpilation settings shared by the circuits of a batch, set once per process by _init_transpile
+_transpile_context = {}
+
+
+def _init_transpile(topology, gates, optimization_level):
+    _transpile_context.update(topology=topology, gates=gates, optimization_level=optimization_level, targets={})
+
+
+def _target(n_qubits):
+    """ Transpilation target for circuits of n_qubits, built once per process and number of qubits. """
+    targets, topology = _transpile_context['targets'], _transpile_context['topology']
+    if n_qubits not in targets:
+        standard = get_standard_gate_name_mapping()
+        # gates known to qiskit, with a coupling map only the ones acting on at most 2 qubits
+        gates = [gate for gate in _transpile_context['gates']
+                 if gate in standard and (topology is None or standard[gate].num_qubits <= 2)]
+        coupling_map = None if topology is None else CouplingMap(topology)
+        size = n_qubits if coupling_map is None else max(n_qubits, coupling_map.size())
+        targets[n_qubits] = Target.from_configuration(gates, num_qubits=size, coupling_map=coupling_map)
+    return targets[n_qubits]
+
+
+def _transpile(unitaries):
+    """ Decomposition of a chunk of unitaries with the settings of _transpile_context. """
+    circuits = []
+    for unitary in unitaries:
+        n_qubits = int(np.log2(unitary.shape[0]))
+        circ = QuantumCircuit(n_qubits)
+        circ.unitary(unitary, [i for i in range(n_qubits)])
+        # one circuit per call, so that qiskit does not spawn processes inside the workers
+        circuits.append(transpile(circ, target=_target(n_qubits),
+                                  optimization_level=_transpile_context['optimization_level']))
+    return circuits
+
+
+def _cache_key(unitary, topology, gates, optimization_level):
+    digest = hashlib.sha256(np.ascontiguousarray(unitary, dtype=complex).tobytes()).hexdigest()
+    topology = None if topology is None else tuple(sorted(tuple(edge) for edge in topology))
+    return digest, unitary.shape, topology, tuple(gates), optimization_level
+
+
+def gate_decomposition_batch(unitaries, topology=None, gates=None, optimization_level=2, workers=None):
+    """ Decomposition of many unitaries (e.g. of a walker at different times or on different graphs) into circuits
+    of the given gate set, transpiled in parallel with the same coupling map and basis gates.
+
+    Decompositions are cached by hash of the unitary, topology, gate set and optimization level, so that repeated
+    unitaries are transpiled only once.
+
+    Parameters
+    ----------
+    unitaries : list of np.array
+        unitary matrices with dimension a power of 2
+    topology : list of [int, int] (default None)
+        coupling map of the qubits, all to all by default
+    gates : list of str (default None)
+        basis gates of the decomposition, defaults to DEFAULT_BASIS_GATES. Gates that are not standard gates of
+        qiskit raise a ValueError (the default gates unknown to the installed qiskit are ignored), while gates on
+        more than 2 qubits are ignored when a topology is given.
+    optimization_level : int (default 2)
+        optimization level of qiskit's transpile
+    workers : integer (default None)
+        number of worker processes, defaults to the number of cpus. With 1 worker the unitaries are decomposed in
+        process.
+
+    Returns
+    -------
+    (list of qiskit.QuantumCircuit, np.array)
+        decomposed circuits and structured array with one row per unitary and fields 'depth', 'size' (number of
+        gates), 'nonlocal_gates' and the count of each gate appearing in the decompositions
+    """
+    if gates is not None:
+        unknown = sorted(set(gates) - set(get_standard_gate_name_mapping()))
+        if unknown:
+            raise ValueError('Unsupported gates %s, the gates must be standard gates of qiskit' % ', '.join(unknown))
+    gates = DEFAULT_BASIS_GATES if gates is None else sorted(gates)
+    unitaries = [np.asarray(unitary) for unitary in unitaries]
+    for unitary in unitaries:
+        # TODO: check unitarity
+        assert unitary.shape[0] == 2 ** int(np.log2(unitary.shape[0])), \
+            'The dimension of the unitary must be a power of 2'
+
+    keys = [_cache_key(unitary, topology, gates, optimization_level) for unitary in unitaries]
+    # first occurrence of every unitary missing from the cache
+    missing = OrderedDict()
+    for index, key in enumerate(keys):
+        if key not in _decompositions and key not in missing:
+            missing[key] = index
+    missing = list(missing.items())
+    if missing:
+        todo = [unitaries[index] for _, index in missing]
+        initargs = (topology, gates, optimization_level)
+        if workers == 1 or len(todo) == 1:
+            _init_transpile(*initargs)
+            circuits = _transpile(todo)
         else:
-            DEFAULT_BASIS_GATES = sorted(gates)
-
-        configuration = BackendConfiguration(
-            backend_name='fake_backend',
-            backend_version='0.0.0',
-            n_qubits=4,
-            basis_gates=DEFAULT_BASIS_GATES,
-            simulator=False,
-            local=True,
-            conditional=False,
-            open_pulse=False,
-            memory=False,
-            max_shots=65536,
-            gates=[],
-            coupling_map=cmap,
-        )
-        super().__init__(configuration)
-        self.time_alive = time_alive
-
-    def properties(self):
-        """Return backend properties"""
-        properties = {
-            'backend_name': self.name(),
-            'backend_version': self.configuration().backend_version,
-            'last_update_date': '2000-01-01 00:00:00Z',
-            'qubits': [],
-            'gates': [],
-            'general': []
-        }
-
-        return BackendProperties.from_dict(properties)
-
-    def run(self, qobj):
-        job_id = str('fake_run')
-        job = self.run_job(job_id, qobj)
-        job.submit()
-        return job
-
-    def run_job(self, job_id, qobj):
-        """Main dummy run loop"""
-        time.sleep(self.time_alive)
-
-        return Result.from_dict(
-            {'job_id': job_id, 'result': [], 'status': 'COMPLETED'})
+            workers = workers or os.cpu_count()
+            chunks = [chunk for chunk in np.array_split(np.arange(len(todo)), min(4 * workers, len(todo)))
+                      if len(chunk)]
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_transpile, initargs=initargs) as pool:
+                circuits = [circuit for chunk in pool.map(_transpile, [[todo[i] for i in chunk] for chunk in chunks])
+                            for circuit in chunk]
+        # the cache keeps its own copies, so that callers can modify the circuits they get
+        for (key, _), circuit in zip(missing, circuits):
+            _decompositions[key] = circuit.copy()
+    circuits = []
+    for key in keys:
+        _decompositions.move_to_end(key)
+        circuits.append(_decompositions[key].copy())
+    while len(_decompositions) > CACHE_SIZE:
+        _decompositions.popitem(last=False)
+
+    counts = [circuit.count_ops() for circuit in circuits]
+    names = sorted(set().union(*counts))
+    summary = np.zeros(len(circuits), dtype=[('depth', int), ('size', int), ('nonlocal_gates', int)] +
+                       [(name, int) for name in names])
+    summary['depth'] = [circuit.depth() for circuit in circuits]
+    summary['size'] = [circuit.size() for circuit in circuits]
+    summary['nonlocal_gates'] = [circuit.num_nonlocal_gates() for circuit in circuits]
+    for name in names:
+        summary[name] = [count.get(name, 0) for count in counts]
+    return circuits, summary
 
 
 def gate_decomposition(unitary, topology=None, gates=None):
-    N = unitary.shape[0]
-    n_qubits = int(np.log2(N))
-
-    # TODO: check unitarity
-    assert N == 2**n_qubits, 'The dimension of the unitary must be a power of 2'
-
-    circ = QuantumCircuit(n_qubits)
-    circ.unitary(unitary, [i for i in range(n_qubits)])
-    backend = FakeBackend(n_qubits=n_qubits, topology=topology, gates=gates)
-    decomposition = transpile(circ, backend=backend, optimization_level=2)
-    decomposition_depth = decomposition.depth()
-    print('Success! Walker decomposed using', decomposition_depth, 'gates.')
-    return decomposition
+    """ Decomposition of a unitary into a circuit of the given gate set (see gate_decomposition_batch). """
+    circuits, _ = gate_decomposition_batch([unitary], topology, gates, workers=1)
+    return circuits[0]
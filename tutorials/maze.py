@@ -1,20 +1,43 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-import matplotlib.pyplot as plt
-from random import randrange, shuffle
+import scipy.sparse as sp
 
+# the 24 orders in which the walk of the generator visits the neighbours of a cell, and the (dx, dy) of each
+_PERMUTATIONS = [(a, b, c, d) for a in range(4) for b in range(4) for c in range(4) for d in range(4)
+                 if len({a, b, c, d}) == 4]
+_DIRECTIONS = [(-1, 0), (0, 1), (1, 0), (0, -1)]
 
-class Maze(object):
 
-    def __init__(self, adjacency=None, maze_size=(20, 20), startNode=0, sinkNode=None):
+class Maze(object):
+    """
+    Perfect maze on a grid of width x height nodes, with a sparse adjacency matrix.
+
+    Parameters
+    ----------
+    adjacency : np.array or scipy.sparse matrix (default None)
+        adjacency matrix of the maze, a new random maze is generated if None
+    maze_size : (int, int) (default (20, 20))
+        width and height of the maze
+    startNode : int (default 0)
+        start node of the walker
+    sinkNode : int (default None)
+        sink node of the walker, defaults to the last node
+    rng : numpy.random.Generator or int (default None)
+        random generator (or seed) of the maze
+    """
+    def __init__(self, adjacency=None, maze_size=(20, 20), startNode=0, sinkNode=None, rng=None):
         self.maze_size = maze_size
         self.width = int(self.maze_size[0])
         self.height = int(self.maze_size[1])
 
         if adjacency is None:
-            self.adjacency = self.generate_adjacency_matrix(self.width, self.height)
+            self.adjacency = self.generate_adjacency_matrix(self.width, self.height, rng)
         else:
             assert self.maze_size == adjacency.shape
             self.adjacency = adjacency
@@ -51,14 +74,16 @@ class Maze(object):
             assert 0 <= value < self.total_nodes, "sinkNode is outside the node range"
             self._sinkNode = value
 
-    def generate_adjacency_matrix(self, w, h):
+    def generate_adjacency_matrix(self, w, h, rng=None):
         """Generate the adjacency matrix of a perfect maze given its width and height.
 
-        Returns a np.array representing the adjacency matrix of a perfect maze with given width and height.
+        Returns a sparse matrix representing the adjacency matrix of a perfect maze with given width and height.
         adjacency[m, n] = 1 if there is a link between node m an n, 0 otherwise.
         The adjacency matrix is symmetric.
 
-        Reference for the algorithm: https://rosettacode.org/wiki/Maze_generation#Python
+        The maze is carved by a depth-first walk with an explicit stack, so that there is no limit on the size
+        of the maze from the recursion depth. Reference for the algorithm:
+        https://rosettacode.org/wiki/Maze_generation#Python
 
         Parameters
         ----------
@@ -66,38 +91,44 @@ class Maze(object):
             number of nodes in the x axis, i.e., the width of the maze
         h : int
             number of nodes in the y axis, i.e., the height of the maze
+        rng : numpy.random.Generator or int (default None)
+            random generator (or seed) of the maze
 
         Returns
         -------
-        np.array, dtype='float64'
+        scipy.sparse.csr_matrix, dtype='float64'
             symmetric adjacency matrix with entry A[i, j] = 1 if there is a link between node i and j, 0 otherwise
         """
-        adjacency = np.zeros([h * w, h * w], dtype='float64')
-        visited = [[0] * w + [1] for _ in range(h)] + [[1] * (w + 1)]
-
-        def pos2node(x, y):
-            return int(x * h + y)
-
-        def walk(x, y):
-            visited[y][x] = 1
-
-            d = [(x - 1, y), (x, y + 1), (x + 1, y), (x, y - 1)]
-            shuffle(d)
-            for (xx, yy) in d:
-                if visited[yy][xx]:
-                    continue
-                if xx == x:
-                    adjacency[pos2node(x, yy), pos2node(x, y)] = 1
-                    adjacency[pos2node(x, y), pos2node(x, yy)] = 1
-                if yy == y:
-                    adjacency[pos2node(x, y), pos2node(xx, y)] = 1
-                    adjacency[pos2node(xx, y), pos2node(x, y)] = 1
-
-                walk(xx, yy)
-
-        walk(randrange(w), randrange(h))
-
-        return adjacency
+        rng = np.random.default_rng(rng)
+        n = w * h
+        # node = x * h + y, each node visits its neighbours in a random order
+        orders = rng.integers(len(_PERMUTATIONS), size=n).tolist()
+        visited = bytearray(n)
+        tried = bytearray(n)  # number of neighbours already tried by each node
+        start = int(rng.integers(n))
+        visited[start] = 1
+        stack = [start]
+        rows, cols = [], []
+        while stack:
+            node = stack[-1]
+            k = tried[node]
+            if k == 4:
+                stack.pop()
+                continue
+            tried[node] = k + 1
+            dx, dy = _DIRECTIONS[_PERMUTATIONS[orders[node]][k]]
+            x, y = divmod(node, h)
+            xx, yy = x + dx, y + dy
+            if 0 <= xx < w and 0 <= yy < h:
+                neighbour = xx * h + yy
+                if not visited[neighbour]:
+                    visited[neighbour] = 1
+                    rows.append(node)
+                    cols.append(neighbour)
+                    stack.append(neighbour)
+
+        rows, cols = np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)
+        return sp.csr_matrix((np.ones(2 * len(rows)), (np.r_[rows, cols], np.r_[cols, rows])), shape=(n, n))
 
     def generate_maze_map(self):
         """Generate the maze map representing the maze as a pixel image from its adjacency matrix.
@@ -113,24 +144,14 @@ class Maze(object):
 
         """
         maze_map = np.zeros([2 * self.height - 1, 2 * self.width - 1], dtype='int')
-        for j in range(self.width - 1):  # defines the upper triangular part of the adjacency matrix
-            for i in range(self.height - 1):
-                if self.adjacency[j * self.height + i, j * self.height + i + 1] > 0:
-                    maze_map[2 * i + 1, 2 * j] = 1
-                if self.adjacency[j * self.height + i, (j + 1) * self.height + i] > 0:
-                    maze_map[2 * i, 2 * j + 1] = 1
-            i = self.height - 1  # last node has no upper neighbour
-            if self.adjacency[j * self.height + i, (j + 1) * self.height + i] > 0:
-                maze_map[2 * i, 2 * j + 1] = 1
-
-        j = self.width - 1  # last node has no right neighbour
-        for i in range(self.height - 1):
-            if self.adjacency[j * self.height + i, j * self.height + i + 1] > 0:
-                maze_map[2 * i + 1, 2 * j] = 1
-
-        for n in range(self.width * self.height):
-            x, y = self.node2xy(n)
-            maze_map[y, x] = 1
+        links = sp.triu(sp.coo_matrix(self.adjacency), k=1).tocoo()
+        m, n = links.row, links.col
+        # only the links between neighbours on the grid, vertical (n = m + 1 in the same column) or horizontal
+        grid = (links.data > 0) & (((n - m == 1) & (m % self.height != self.height - 1)) | (n - m == self.height))
+        m, n = m[grid], n[grid]
+        # the pixel of a link lies between the pixels (2 * (node % height), 2 * (node // height)) of its nodes
+        maze_map[m % self.height + n % self.height, m // self.height + n // self.height] = 1
+        maze_map[::2, ::2] = 1
 
         return maze_map
 
@@ -159,10 +180,12 @@ class Maze(object):
         numpy.ndarray, AxesImage
             numpy array with rgb colors for each pixel, AxesImage obtained from pyplot.imshow() (when plotted)
         """
+        import matplotlib.pyplot as plt
+
         maze_map = self.generate_maze_map()
         xshift = 0.33
         yshift = 0.33
-        cmap = plt.cm.get_cmap('gray')
+        cmap = plt.get_cmap('gray')
         norm = plt.Normalize(maze_map.min(), maze_map.max())
         img = cmap(norm(maze_map))
 
@@ -232,8 +255,11 @@ class Maze(object):
             row = link - (self.height - 1) * self.width - 1
             col = row + self.height
 
-        self.adjacency[row, col] = value
-        self.adjacency[col, row] = value
+        with warnings.catch_warnings():
+            # adding a link changes the structure of a sparse adjacency, removed links are kept as explicit zeros
+            warnings.simplefilter('ignore', sp.SparseEfficiencyWarning)
+            self.adjacency[row, col] = value
+            self.adjacency[col, row] = value
 
         return value
 
@@ -341,3 +367,36 @@ class Maze(object):
             x, y = np.nan, np.nan
 
         return x, y
+
+
+def _generate_maze(task):
+    maze_size, seed = task
+    return Maze(maze_size=maze_size, rng=np.random.default_rng(seed))
+
+
+def generate_mazes(count, maze_size=(20, 20), seed=None, workers=None):
+    """Generate many random mazes in parallel on a pool of processes.
+
+    Parameters
+    ----------
+    count : int
+        number of mazes
+    maze_size : (int, int) (default (20, 20))
+        width and height of the mazes
+    seed : int (default None)
+        seed of the mazes, every maze gets its own seed spawned from it so that the mazes do not depend on the
+        number of workers
+    workers : int (default None)
+        number of worker processes, defaults to the number of cpus. With 1 worker the mazes are generated in process.
+
+    Returns
+    -------
+    list of Maze
+        the generated mazes
+    """
+    tasks = [(maze_size, sequence) for sequence in np.random.SeedSequence(seed).spawn(count)]
+    if workers == 1:
+        return [_generate_maze(task) for task in tasks]
+    chunksize = max(1, count // (4 * (workers or os.cpu_count())))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_generate_maze, tasks, chunksize=chunksize))